@@ -0,0 +1,328 @@
+import argparse
+import itertools
+import json
+import math
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+from db import (REPLIES_STORAGE, compute_stats_summary, copy_embedded_replies,
+                db, delete_tiktok, ensure_indexes, form_db_stored_message,
+                form_db_stored_tiktok, get_interactions,
+                get_not_answered_tiktoks_summary, get_personal_income_stats,
+                get_personal_outcome_stats, get_sent_tiktoks_stats,
+                get_stats_summary, get_tiktoks_with_same_share_key,
+                get_tiktoks_with_same_video_id, get_today_sent_tiktoks_count,
+                get_top_most_popular_reactions, get_unresolved_tiktoks,
+                iter_tiktoks_with_embedded_replies, load_known_video_ids,
+                query_cache, rebuild_daily_stats, rebuild_interactions,
+                rebuild_not_answered_tiktoks, rebuild_reactions,
+                rebuild_sent_tiktoks_counters, save_sent_tiktok,
+                save_tiktok_reply_if_applicable, set_tiktok_video_id)
+from tiktok_utils import count_laugh_indicator
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+# not_answered_tiktoks grows with users x tiktoks, so bigger groups need an explicit --scenario
+DEFAULT_SCENARIOS = ['10x10000', '100x100000']
+PERCENTILES = (50, 95, 99)
+INSERT_BATCH_SIZE = 10000
+HISTORY_DAYS = 730
+DUPLICATE_SHARE = 0.1
+UNRESOLVED_SHARE = 0.05
+MAX_REPLIES = 8
+REPLY_TEXTS = ['ахах', 'ахахах', 'АХАХАХ', 'ахахАХАХ', 'ну такое', 'лол', 'ору ахах', None]
+
+
+class Benchmark:
+    def __init__(self, users_count: int, tiktoks_count: int, seed: int) -> None:
+        self.users_count = users_count
+        self.tiktoks_count = tiktoks_count
+        self.random = random.Random(seed)
+
+        self.users = []
+        self.video_ids = []
+        self.share_keys = []
+        self.next_message_id = 1
+
+    def generate(self) -> None:
+        db.client.drop_database(db.name)
+        ensure_indexes()
+
+        self.users = [
+            {
+                'user_id': 1000 + i,
+                'name': f'User{i}',
+                'gen': self.random.choice('mf'),
+                'last_replied_tiktok_id': None,
+                'last_replied_at': None,
+                'tiktoks_replied_count': 0
+            }
+            for i in range(self.users_count)
+        ]
+        db.users.insert_many(self.users)
+
+        now = datetime.utcnow()
+        unique_videos_count = max(1, int(self.tiktoks_count * (1 - DUPLICATE_SHARE)))
+        batch = []
+
+        for i in range(self.tiktoks_count):
+            sent_at = now - timedelta(seconds=self.random.randrange(HISTORY_DAYS * 24 * 60 * 60))
+            batch.append(self._form_tiktok(sent_at, self.random.randrange(unique_videos_count)))
+
+            if len(batch) == INSERT_BATCH_SIZE:
+                db.tiktoks.insert_many(batch, ordered=False)
+                batch = []
+
+        if batch:
+            db.tiktoks.insert_many(batch, ordered=False)
+
+        if REPLIES_STORAGE != 'embedded':
+            tiktoks = iter_tiktoks_with_embedded_replies(batch_size=INSERT_BATCH_SIZE)
+
+            while batch := list(itertools.islice(tiktoks, INSERT_BATCH_SIZE)):
+                copy_embedded_replies(batch, drop_embedded=REPLIES_STORAGE == 'collection')
+
+        rebuild_sent_tiktoks_counters()
+        rebuild_not_answered_tiktoks()
+        rebuild_daily_stats()
+        rebuild_reactions()
+        rebuild_interactions()
+        load_known_video_ids()
+
+    def _form_tiktok(self, sent_at: datetime, video_number: int) -> dict:
+        sender = self.random.choice(self.users)
+        share_key = f'B{video_number:x}'
+        video_id = None if self.random.random() < UNRESOLVED_SHARE else f'69{video_number:017d}'
+
+        tiktok = form_db_stored_tiktok(
+            sender['user_id'], self._take_message_id(), sent_at,
+            f'https://vm.tiktok.com/{share_key}/', video_id
+        )
+
+        repliers = [u for u in self.random.sample(self.users, min(len(self.users), MAX_REPLIES + 1))
+                    if u['user_id'] != sender['user_id']]
+        tiktok['replies'] = []
+
+        for replier in repliers[:self.random.randint(0, MAX_REPLIES)]:
+            text = self.random.choice(REPLY_TEXTS)
+            reply = form_db_stored_message(
+                replier['user_id'], self._take_message_id(),
+                sent_at + timedelta(seconds=self.random.randrange(2 * 24 * 60 * 60)), text
+            )
+            reply['laugh_indicator'] = count_laugh_indicator(text)
+            tiktok['replies'].append(reply)
+
+        if len(self.share_keys) < 1000:
+            self.share_keys.append(share_key)
+
+            if video_id:
+                self.video_ids.append(video_id)
+
+        return tiktok
+
+    def _take_message_id(self) -> int:
+        message_id = self.next_message_id
+        self.next_message_id += 1
+
+        return message_id
+
+    def run(self, repeat: int) -> dict[str, dict]:
+        month_ago = datetime.utcnow() - timedelta(days=30)
+        user_ids = [u['user_id'] for u in self.users]
+
+        def random_user_id() -> int:
+            return self.random.choice(user_ids)
+
+        reads = {
+            'get_stats_summary': lambda: get_stats_summary(),
+            'get_stats_summary(month)': lambda: get_stats_summary(month_ago),
+            'compute_stats_summary': lambda: compute_stats_summary(),
+            'get_sent_tiktoks_stats': lambda: get_sent_tiktoks_stats(),
+            'get_sent_tiktoks_stats(month)': lambda: get_sent_tiktoks_stats(month_ago),
+            'get_not_answered_tiktoks_summary': lambda: get_not_answered_tiktoks_summary(random_user_id()),
+            'get_tiktoks_with_same_video_id': lambda: get_tiktoks_with_same_video_id(
+                random_user_id(), self.random.choice(self.video_ids)
+            ),
+            'get_tiktoks_with_same_share_key': lambda: get_tiktoks_with_same_share_key(
+                random_user_id(), self.random.choice(self.share_keys)
+            ),
+            'get_top_most_popular_reactions': lambda: get_top_most_popular_reactions(random_user_id()),
+            'get_top_most_popular_reactions(month)': lambda: get_top_most_popular_reactions(
+                random_user_id(), month_ago
+            ),
+            'get_interactions': lambda: get_interactions(),
+            'get_interactions(month)': lambda: get_interactions(month_ago),
+            'get_personal_income_stats': lambda: get_personal_income_stats(random_user_id()),
+            'get_personal_outcome_stats': lambda: get_personal_outcome_stats(random_user_id()),
+            'get_today_sent_tiktoks_count': lambda: get_today_sent_tiktoks_count(random_user_id()),
+            'get_unresolved_tiktoks': lambda: get_unresolved_tiktoks(100),
+        }
+
+        results = {name: measure(func, repeat) for name, func in reads.items()}
+
+        new_tiktoks = []
+
+        def save_new_tiktok() -> None:
+            message_id = self._take_message_id()
+            user_id = random_user_id()
+            save_sent_tiktok(
+                user_id, message_id, datetime.utcnow(),
+                f'https://vm.tiktok.com/Bench{message_id}/', None
+            )
+            new_tiktoks.append((message_id, user_id))
+
+        def save_new_reply() -> None:
+            message_id, sent_by_id = self.random.choice(new_tiktoks)
+            replier = self.random.choice([u for u in self.users if u['user_id'] != sent_by_id] or self.users)
+            save_tiktok_reply_if_applicable(
+                replier, message_id, self._take_message_id(),
+                datetime.utcnow(), self.random.choice(REPLY_TEXTS)
+            )
+
+        results['save_sent_tiktok'] = measure(save_new_tiktok, repeat)
+        results['set_tiktok_video_id'] = measure(
+            lambda: set_tiktok_video_id(self.random.choice(new_tiktoks)[0], f'bench{self.random.random()}'),
+            repeat
+        )
+        results['save_tiktok_reply_if_applicable'] = measure(save_new_reply, repeat)
+        results['delete_tiktok'] = measure(lambda: delete_tiktok(new_tiktoks.pop()[0]), repeat)
+
+        return results
+
+
+def measure(func: Callable, repeat: int) -> dict:
+    timings = []
+
+    try:
+        for _ in range(repeat):
+            # Time the database, not the in-process query cache
+            query_cache.invalidate()
+            started_at = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started_at) * 1000)
+    except Exception as e:
+        return {'error': repr(e)}
+
+    return {f'p{p}': percentile(timings, p) for p in PERCENTILES}
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(len(values) * p / 100) - 1)]
+
+
+def find_failures(results: dict) -> list[str]:
+    return [
+        f"{scenario} {name}: {timings['error']}"
+        for scenario, functions in results.items()
+        for name, timings in functions.items() if 'error' in timings
+    ]
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+
+    for scenario, functions in results.items():
+        for name, timings in functions.items():
+            baseline_timings = baseline.get(scenario, {}).get(name, {})
+
+            for key, value in timings.items():
+                baseline_value = baseline_timings.get(key)
+
+                if isinstance(baseline_value, float) and value > baseline_value * (1 + threshold):
+                    regressions.append(
+                        f'{scenario} {name} {key}: {baseline_value:.2f} ms -> {value:.2f} ms'
+                    )
+
+    return regressions
+
+
+def print_results(scenario: str, results: dict) -> None:
+    print(f'\n{scenario}')
+    width = max(len(name) for name in results)
+
+    for name, timings in results.items():
+        if 'error' in timings:
+            print(f"{name:<{width}}  failed: {timings['error']}")
+        else:
+            print(f'{name:<{width}}  ' + '  '.join(f'{k} {v:>9.2f} ms' for k, v in timings.items()))
+
+
+def connect(args: argparse.Namespace) -> None:
+    if args.mongomock:
+        if not mongomock:
+            sys.exit('mongomock is not installed, run "pip install mongomock" or use a local mongod')
+
+        db.use(mongomock.MongoClient()[args.db_name])
+    else:
+        db.connect(args.dsn, args.db_name)
+
+
+def parse_scenario(scenario: str) -> tuple[int, int]:
+    users_count, tiktoks_count = scenario.lower().split('x')
+    return int(users_count), int(tiktoks_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time db.py queries and writes against synthetic groups')
+    parser.add_argument('--scenario', action='append', type=parse_scenario,
+                        help=f"USERSxTIKTOKS, can be repeated (default: {' '.join(DEFAULT_SCENARIOS)})")
+    parser.add_argument('--dsn', help='mongodb DSN of the benchmark server (default: MONGO_DB_DSN)')
+    parser.add_argument('--db-name', default='tiktok_benchmark', help='database that is dropped and refilled')
+    parser.add_argument('--mongomock', action='store_true', help='use in-process mongomock instead of mongod')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', help='write the JSON results of this run to the path')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    if args.db_name == 'tiktok':
+        sys.exit('Refusing to drop the production database, pick another --db-name')
+
+    connect(args)
+
+    all_results = {}
+
+    for users_count, tiktoks_count in args.scenario or map(parse_scenario, DEFAULT_SCENARIOS):
+        scenario = f'{users_count}x{tiktoks_count}'
+        benchmark = Benchmark(users_count, tiktoks_count, args.seed)
+
+        started_at = time.perf_counter()
+        benchmark.generate()
+        print(f'\nGenerated {scenario} in {time.perf_counter() - started_at:.1f} s')
+
+        all_results[scenario] = benchmark.run(args.repeat)
+        print_results(scenario, all_results[scenario])
+
+    db.client.drop_database(db.name)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+    failures = find_failures(all_results)
+    regressions = []
+
+    if failures:
+        print(f'\n{len(failures)} measurements failed')
+
+        for failure in failures:
+            print(failure)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(all_results, json.load(f), args.threshold)
+
+        print(f'\n{len(regressions)} regressions against {args.baseline}')
+
+        for regression in regressions:
+            print(regression)
+
+    sys.exit(1 if failures or regressions else 0)
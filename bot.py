@@ -1,34 +1,49 @@
 
+import functools
 import os
 import re
 import traceback
 from datetime import datetime, timedelta, timezone
+from queue import Queue
 from typing import Optional
 
-import pymorphy2
 import telegram
+from pymongo.errors import ExecutionTimeout
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
-                          CommandHandler, Defaults, Filters, MessageHandler,
-                          Updater)
+                          CommandHandler, Defaults, Dispatcher, ExtBot,
+                          Filters, MessageHandler, Updater)
 from telegram.update import Message, Update
-
-from db import (STRICT_MODE_START_FROM, db, get_income_replies_stats,
-                get_not_answered_tiktoks, get_outcome_replies_tiktoks_stats,
-                get_sent_tiktoks_stats, get_tiktoks_with_same_video_id,
-                get_today_sent_tiktoks_count, get_top_most_popular_reactions,
-                save_sent_tiktok, save_tiktok_reply_if_applicable)
+from telegram.utils.request import Request
+
+from bounded_dispatcher import BoundedDispatcher
+from db import (STRICT_MODE_START_FROM, bootstrap_derived_collections, db,
+                delete_tiktok, ensure_indexes,
+                get_not_answered_tiktoks_summary, get_personal_income_stats,
+                get_personal_outcome_stats, get_stats_summary,
+                get_tiktoks_with_same_share_key,
+                get_tiktoks_with_same_video_id, get_top_most_popular_reactions,
+                load_known_video_ids, save_sent_tiktok,
+                save_tiktok_reply_if_applicable, set_tiktok_video_id,
+                start_known_video_ids_reload)
+from metrics import (dispatcher_queue_depth, register_mongo_listener,
+                     start_metrics_server, timed_handler)
+from outbox import Outbox
+from plural import make_agree_with_number
+from resolver import resolve_video_id, start_backfill, submit_resolution
 from security import known_user
-from tiktok import EXTRACT_SHARE_URL_FROM_TIKTOK, get_tiktok_id_by_share_url
+from startup import StartupTimer
+from tiktok import EXTRACT_SHARE_URL_FROM_TIKTOK, get_share_key
 from tiktok_utils import milliseconds_to_string_duration
+from user_directory import user_directory
+from webhook import serve_webhook
 
-morph = pymorphy2.MorphAnalyzer()
-
-defaults = Defaults(parse_mode=telegram.ParseMode.HTML)
-updater = Updater(token=os.environ['BOT_TOKEN'], defaults=defaults)
-
-dispatcher = updater.dispatcher
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+DISPATCHER_WORKERS = int(os.environ.get('DISPATCHER_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+VIDEO_ID_BACKFILL_INTERVAL_SECONDS = int(os.environ.get('VIDEO_ID_BACKFILL_INTERVAL_SECONDS', 3600))
+VIDEO_ID_INDEX_RELOAD_SECONDS = int(os.environ.get('VIDEO_ID_INDEX_RELOAD_SECONDS', 600))
 
 COMMANDS = [
     ('start', 'посмотреть инструкцию'),
@@ -37,60 +52,76 @@ COMMANDS = [
     ('search', 'искать по ссылке'),
 ]
 
-success = updater.bot.set_my_commands(COMMANDS)
-
-if not success:
-    raise ValueError('Error settings commands')
-
 
+@timed_handler('tiktok')
 @known_user
 def tiktok_handler(user: dict, update: Update, context: CallbackContext) -> None:
     message = update.effective_message
     chat_id = update.effective_chat.id
 
     video_url = context.match.group(1)
-    video_id = None
 
+    sent_user = save_sent_tiktok(
+        user['user_id'], message.message_id,
+        message.date, message.text, None
+    )
+
+    submit_resolution(
+        video_url,
+        functools.partial(on_tiktok_resolved, chat_id, video_url, message, user, sent_user, update, context)
+    )
+
+
+@timed_handler('tiktok_resolved')
+def on_tiktok_resolved(chat_id: int, video_url: str, message: Message, user: dict,
+                       sent_user: Optional[dict], update: Update, context: CallbackContext,
+                       video_id: Optional[str], error: Optional[Exception]) -> None:
     try:
-        video_id = get_tiktok_id_by_share_url(video_url)
-    except Exception as e:
-        context.bot.send_message(
-            chat_id=26187519,
-            text=f'Cannot get video_id of tiktok {video_url}\n\n{repr(e)}'
+        if error:
+            context.bot_data['outbox'].send_message(
+                chat_id=26187519,
+                text=f'Cannot get video_id of tiktok {video_url}\n\n{repr(error)}'
+            )
+
+        is_duplicate = send_is_duplicate_if_applicable(
+            chat_id, message, video_id, user, update, context
         )
 
-    is_duplicate = send_is_duplicate_if_applicable(
-        chat_id, video_id, user, update, context
-    )
+        if is_duplicate:
+            delete_tiktok(message.message_id)
+            return
 
-    if is_duplicate:
-        return
+        if video_id:
+            set_tiktok_video_id(message.message_id, video_id)
 
-    save_sent_tiktok(
-        user['user_id'], message.message_id,
-        message.date, message.text, video_id
-    )
+        send_has_not_answered_if_applicable(chat_id, message, user, update, context)
 
-    send_has_not_answered_if_applicable(chat_id, message, user, update, context)
-    send_milestones_if_applicable(chat_id, user, update, context)
+        if sent_user:
+            send_milestones_if_applicable(chat_id, user, sent_user, update, context)
+    except Exception as e:
+        context.error = e
+        error_handler(update, context)
 
 
-def send_is_duplicate_if_applicable(chat_id: int, video_id: str, user: dict,
+def send_is_duplicate_if_applicable(chat_id: int, message: Message, video_id: Optional[str], user: dict,
                                     update: Update, context: CallbackContext) -> bool:
+    share_key = get_share_key(message.text)
 
-    if not video_id:
-        return
+    if video_id:
+        already_sent_tiktoks = get_tiktoks_with_same_video_id(user['user_id'], video_id, share_key)
+    elif share_key:
+        already_sent_tiktoks = get_tiktoks_with_same_share_key(user['user_id'], share_key)
+    else:
+        return False
 
-    already_sent_tiktoks = get_tiktoks_with_same_video_id(
-        user['user_id'], video_id
-    )
+    already_sent_tiktoks = [t for t in already_sent_tiktoks if t['message_id'] != message.message_id]
 
     if not already_sent_tiktoks:
         return False
 
     already_sent_tiktok = already_sent_tiktoks[0]
     sent_user = already_sent_tiktok['user']
-    context.bot.send_message(
+    context.bot_data['outbox'].send_message(
         chat_id=chat_id,
         text=(
             '🤔 Хмм... Кажется этот тикток уже присылали. '
@@ -101,13 +132,13 @@ def send_is_duplicate_if_applicable(chat_id: int, video_id: str, user: dict,
     )
 
     if already_sent_tiktok['sent_at'] > STRICT_MODE_START_FROM:
-        context.bot.forward_message(
+        context.bot_data['outbox'].forward_message(
             chat_id=chat_id,
             from_chat_id=chat_id,
             message_id=already_sent_tiktok['message_id']
         )
     else:
-        context.bot.send_message(
+        context.bot_data['outbox'].send_message(
             chat_id=chat_id,
             text=(
                 'Пруф я переслать не могу, потому что меня тогда еще не было в чате. '
@@ -120,12 +151,14 @@ def send_is_duplicate_if_applicable(chat_id: int, video_id: str, user: dict,
 
 def send_has_not_answered_if_applicable(chat_id: int, message: Message, user: dict,
                                         update: Update, context: CallbackContext) -> None:
-    not_answered_tiktoks = get_not_answered_tiktoks(user['user_id'], offset_from_now=timedelta(hours=1))
+    not_answered_count, oldest_message_id = get_not_answered_tiktoks_summary(
+        user['user_id'], offset_from_now=timedelta(hours=1)
+    )
 
-    if not_answered_tiktoks:
-        context.bot.send_message(
+    if not_answered_count:
+        context.bot_data['outbox'].send_message(
             chat_id=chat_id,
-            reply_to_message_id=not_answered_tiktoks[0]['message_id'],
+            reply_to_message_id=oldest_message_id,
             text=(
                 f"🤫 Kind reminder! {user['name']}, у тебя есть неотвеченные тиктоки, а "
                 'ты присылаешь новые. Ведь те тиктоки ценнее, чем в ленте: за тебя их уже отобрали '
@@ -134,15 +167,14 @@ def send_has_not_answered_if_applicable(chat_id: int, message: Message, user: di
         )
 
 
-def send_milestones_if_applicable(chat_id: int, user: dict,
+def send_milestones_if_applicable(chat_id: int, user: dict, sent_user: dict,
                                   update: Update, context: CallbackContext) -> None:
-    tiktok_morph = morph.parse('тикток')[0]
-    user_sent_tiktoks_count = get_sent_tiktoks_stats().get(user['user_id'], {}).get('sent_count', -1)
-    today_sent_tiktoks_count = get_today_sent_tiktoks_count(user['user_id'])
+    user_sent_tiktoks_count = sent_user['tiktoks_sent_count']
+    today_sent_tiktoks_count = sent_user['tiktoks_sent_today_count']
 
     if user_sent_tiktoks_count % 100 == 0:
-        tiktoks_word = tiktok_morph.make_agree_with_number(user_sent_tiktoks_count).word
-        context.bot.send_message(
+        tiktoks_word = make_agree_with_number('тикток', user_sent_tiktoks_count)
+        context.bot_data['outbox'].send_message(
             chat_id=chat_id,
             text=(
                 f"🥂 {user['name']}, а у тебя юбилей! За все время ты отправил{'a' if user['gen'] == 'f' else ''} "
@@ -151,8 +183,8 @@ def send_milestones_if_applicable(chat_id: int, user: dict,
         )
 
     if today_sent_tiktoks_count % 15 == 0:
-        tiktoks_word = tiktok_morph.make_agree_with_number(today_sent_tiktoks_count).word
-        context.bot.send_message(
+        tiktoks_word = make_agree_with_number('тикток', today_sent_tiktoks_count)
+        context.bot_data['outbox'].send_message(
             chat_id=chat_id,
             text=(
                 f"👍 Вау, вот это контент! За сегодня {user['name']} послал{'a' if user['gen'] == 'f' else ''} уже "
@@ -161,6 +193,7 @@ def send_milestones_if_applicable(chat_id: int, user: dict,
         )
 
 
+@timed_handler('reply')
 @known_user
 def reply_handler(user: dict, update: Update, context: CallbackContext) -> None:
     message = update.effective_message
@@ -171,6 +204,7 @@ def reply_handler(user: dict, update: Update, context: CallbackContext) -> None:
     )
 
 
+@timed_handler('start')
 @known_user
 def start(user: dict, update: Update, context: CallbackContext) -> None:
     commands_info = '\n\n'.join(
@@ -190,9 +224,10 @@ def start(user: dict, update: Update, context: CallbackContext) -> None:
     )
 
 
+@timed_handler('stats')
 @known_user
 def stats(user: dict, update: Update, context: CallbackContext) -> None:
-    all_users = list(db.users.find({}).sort('name', 1))
+    all_users = user_directory.get_all()
 
     for_user_id = None
     start_date = None
@@ -200,14 +235,9 @@ def stats(user: dict, update: Update, context: CallbackContext) -> None:
     if args := context.args:
         for arg in args[:2]:
             # Try parse user
-            found_user = None
-
-            try:
-                found_user = next(u for u in all_users if u['name'].lower() == arg.lower())
+            if found_user := user_directory.get_by_name(arg):
                 for_user_id = found_user['user_id']
                 continue
-            except StopIteration:
-                pass
 
             # Or try parse date
             try:
@@ -215,10 +245,16 @@ def stats(user: dict, update: Update, context: CallbackContext) -> None:
             except ValueError:
                 pass
 
-    if for_user_id:
-        text = form_stats_for_person(for_user_id, all_users, start_date)
-    else:
-        text = form_stats_summary(all_users, start_date)
+    try:
+        if for_user_id:
+            text = form_stats_for_person(for_user_id, all_users, start_date)
+        else:
+            text = form_stats_summary(all_users, start_date)
+    except ExecutionTimeout:
+        text = (
+            '⏳ Статистика считается слишком долго, поэтому я ее прервал. '
+            'Попробуй указать дату, с которой считать: <code>/stats "DD.MM.YYYY"</code>'
+        )
 
     context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -227,11 +263,10 @@ def stats(user: dict, update: Update, context: CallbackContext) -> None:
 
 
 def form_stats_summary(users: list, start_date: Optional[datetime]) -> str:
-    tiktok_morph = morph.parse('тикток')[0]
-
-    sent_stats = get_sent_tiktoks_stats(start_date)
-    outcome_replies_stats = get_outcome_replies_tiktoks_stats(start_date)
-    income_replies_stats = get_income_replies_stats(start_date)
+    stats_summary = get_stats_summary(start_date)
+    sent_stats = stats_summary['sent']
+    outcome_replies_stats = stats_summary['outcome']
+    income_replies_stats = stats_summary['income']
 
     text = ''
 
@@ -243,7 +278,7 @@ def form_stats_summary(users: list, start_date: Optional[datetime]) -> str:
         text += f"<b>{user['name']}</b>\n"
 
         if user_sent_stats and user_sent_stats['sent_count']:
-            tiktoks_word = tiktok_morph.make_agree_with_number(user_sent_stats['sent_count']).word
+            tiktoks_word = make_agree_with_number('тикток', user_sent_stats['sent_count'])
             got_answers_percent = round(user_sent_stats['got_replies_count'] / user_sent_stats['sent_count'] * 100)
 
             text += (
@@ -256,9 +291,9 @@ def form_stats_summary(users: list, start_date: Optional[datetime]) -> str:
             if user_income_replies_stats:
                 text += (
                     f"AVG получает ответ за "
-                    f"{milliseconds_to_string_duration(user_income_replies_stats['avg_income_reply_time'])}, "
+                    f"{milliseconds_to_string_duration(user_income_replies_stats['avg_reply_time'])}, "
                     f"AVG длина получаемого ахаха — "
-                    f"{round(user_income_replies_stats['avg_income_laugh_indicator'], 1)}"
+                    f"{round(user_income_replies_stats['avg_laugh_indicator'], 1)}"
                 )
 
         else:
@@ -284,9 +319,9 @@ def form_stats_summary(users: list, start_date: Optional[datetime]) -> str:
             if user_outcome_replies_stats:
                 text += (
                     f"AVG отвечает за "
-                    f"{milliseconds_to_string_duration(user_outcome_replies_stats['avg_outcome_reply_time'])}, "
+                    f"{milliseconds_to_string_duration(user_outcome_replies_stats['avg_reply_time'])}, "
                     f"AVG длина ахаха в ответе — "
-                    f"{round(user_outcome_replies_stats['avg_outcome_laugh_indicator'], 1)}"
+                    f"{round(user_outcome_replies_stats['avg_laugh_indicator'], 1)}"
                 )
         else:
             text += f"А отвечать {'ей' if user['gen'] == 'f' else 'ему'} некому — нет тиктоков"
@@ -297,12 +332,45 @@ def form_stats_summary(users: list, start_date: Optional[datetime]) -> str:
 
 
 def form_stats_for_person(user_id: int, users: list, start_date: Optional[datetime]) -> str:
-    text = (
-        'Тут будет статистика чтобы понять кто кому как отвечает, но потом...\n\n'
-    )
+    person = next(u for u in users if u['user_id'] == user_id)
+    others = [u for u in users if u['user_id'] != user_id]
+
+    sent_stats = get_stats_summary(start_date)['sent']
+    income_stats = get_personal_income_stats(user_id, start_date)
+    outcome_stats = get_personal_outcome_stats(user_id, start_date)
+
+    person_sent_count = sent_stats.get(user_id, {}).get('sent_count', 0)
+    others_sent_counts = {u['user_id']: sent_stats.get(u['user_id'], {}).get('sent_count', 0) for u in others}
+
+    text = f"<b>{person['name']}</b>\n\n"
+
+    text += f"Кто отвечает на тиктоки {person['name']}:\n"
+    if person_sent_count:
+        for other in others:
+            text += form_interaction_line(other, income_stats.get(other['user_id']), person_sent_count)
+    else:
+        text += 'Нет тиктоков за период\n'
+
+    text += f"\nНа чьи тиктоки отвечает {person['name']}:\n"
+    for other in others:
+        if others_sent_counts[other['user_id']]:
+            text += form_interaction_line(
+                other, outcome_stats.get(other['user_id']), others_sent_counts[other['user_id']]
+            )
 
-    # get_personal_income_stats(user_id, start_date)
-    # get_personal_outcome_stats(user_id, start_date)
+    ignored_by = {
+        other['name']: person_sent_count - income_stats[other['user_id']]['replies_count']
+        if other['user_id'] in income_stats else person_sent_count
+        for other in others
+    }
+    ignores = {
+        other['name']: others_sent_counts[other['user_id']] - outcome_stats[other['user_id']]['replies_count']
+        if other['user_id'] in outcome_stats else others_sent_counts[other['user_id']]
+        for other in others
+    }
+
+    text += f"\n🙈 Чаще всего игнорируют {person['name']}: {form_top_ignores(ignored_by)}\n"
+    text += f"🙉 {person['name']} чаще всего игнорирует: {form_top_ignores(ignores)}\n\n"
 
     reactions = get_top_most_popular_reactions(user_id, start_date)
 
@@ -316,32 +384,53 @@ def form_stats_for_person(user_id: int, users: list, start_date: Optional[dateti
     return text
 
 
+def form_interaction_line(user: dict, interaction_stats: Optional[dict], sent_count: int) -> str:
+    replies_count = interaction_stats['replies_count'] if interaction_stats else 0
+    text = (
+        f"— {user['name']}: <code>{replies_count}</code> из <code>{sent_count}</code> "
+        f"({round(replies_count / sent_count * 100)}%)"
+    )
+
+    if interaction_stats:
+        avg_reply_time = milliseconds_to_string_duration(interaction_stats['avg_reply_time']) or '< 1 м.'
+        median_reply_time = milliseconds_to_string_duration(interaction_stats['median_reply_time']) or '< 1 м.'
+        text += (
+            f", AVG за {avg_reply_time}, медиана {median_reply_time}, "
+            f"AVG ахаха — {round(interaction_stats['avg_laugh_indicator'], 1)}"
+        )
+
+    return text + '\n'
+
+
+def form_top_ignores(ignores: dict[str, int]) -> str:
+    top_ignores = sorted([(count, name) for name, count in ignores.items() if count > 0], reverse=True)[:3]
+
+    if not top_ignores:
+        return 'никто'
+
+    return ', '.join(f'{name} (<code>{count}</code>)' for count, name in top_ignores)
+
+
+@timed_handler('watch')
 @known_user
 def watch(user: dict, update: Update, context: CallbackContext) -> None:
     chat_id = update.effective_chat.id
 
-    all_users = list(db.users.find({}).sort('name', 1))
-
     watch_user = user
 
     if args := context.args:
-        try:
-            found_user = next(u for u in all_users if u['name'].lower() == args[0].lower())
-            watch_user = found_user
-        except StopIteration:
-            pass
+        watch_user = user_directory.get_by_name(args[0]) or user
 
-    not_answered_tiktoks = get_not_answered_tiktoks(watch_user['user_id'])
+    tiktoks_count, oldest_message_id = get_not_answered_tiktoks_summary(watch_user['user_id'])
 
-    if not_answered_tiktoks:
-        tiktoks_count = len(not_answered_tiktoks)
-        tiktok_morph = morph.parse('тикток')[0].make_agree_with_number(tiktoks_count).word
+    if tiktoks_count:
+        tiktoks_word = make_agree_with_number('тикток', tiktoks_count)
 
         try:
             context.bot.send_message(
                 chat_id=chat_id,
-                text=f'У тебя {tiktoks_count} {tiktok_morph} к просмотру, начиная с этого 👆',
-                reply_to_message_id=not_answered_tiktoks[0]['message_id']
+                text=f'У тебя {tiktoks_count} {tiktoks_word} к просмотру, начиная с этого 👆',
+                reply_to_message_id=oldest_message_id
             )
         except BadRequest:
             context.bot.send_message(
@@ -351,7 +440,7 @@ def watch(user: dict, update: Update, context: CallbackContext) -> None:
                     'Я, конечно, знаю ссылку, но раз его удалили, то я тоже его удалю... ',
                 )
             )
-            db.tiktoks.delete_one({'message_id': int(not_answered_tiktoks[0]['message_id'])})
+            delete_tiktok(int(oldest_message_id))
     else:
         context.bot.send_message(
             chat_id=chat_id,
@@ -362,6 +451,7 @@ def watch(user: dict, update: Update, context: CallbackContext) -> None:
         )
 
 
+@timed_handler('search')
 @known_user
 def search(user: dict, update: Update, context: CallbackContext) -> None:
     chat_id = update.effective_chat.id
@@ -376,11 +466,13 @@ def search(user: dict, update: Update, context: CallbackContext) -> None:
             chat_id=chat_id,
             text='Не похоже на ссылку на тикток. <code>/manage https://vm.tiktok.com/some_id/</code>'
         )
+        return
 
     video_url = m.group(1)
+    video_id = None
 
     try:
-        video_id = get_tiktok_id_by_share_url(video_url)
+        video_id = resolve_video_id(video_url)
     except Exception as e:
         context.bot.send_message(
             chat_id=chat_id,
@@ -391,9 +483,14 @@ def search(user: dict, update: Update, context: CallbackContext) -> None:
             text=f'Cannot get video_id of tiktok {video_url}\n\n{repr(e)}'
         )
 
-    tiktoks = get_tiktoks_with_same_video_id(
-        user['user_id'], video_id
-    )
+    share_key = get_share_key(video_url)
+
+    if video_id:
+        tiktoks = get_tiktoks_with_same_video_id(user['user_id'], video_id, share_key)
+    elif share_key:
+        tiktoks = get_tiktoks_with_same_share_key(user['user_id'], share_key)
+    else:
+        tiktoks = []
 
     text = 'Использования тиктока:\n'
     reply_markup = None
@@ -415,8 +512,14 @@ def search(user: dict, update: Update, context: CallbackContext) -> None:
     context.bot.send_message(chat_id, text, reply_markup=reply_markup)
 
 
-def callback(update: Update, context: CallbackContext) -> None:
+@timed_handler('callback')
+@known_user
+def callback(user: Optional[dict], update: Update, context: CallbackContext) -> None:
     update.callback_query.answer()
+
+    if not user:
+        return
+
     payload = update.callback_query.data
     chat_id = update.effective_chat.id
 
@@ -443,7 +546,7 @@ def callback(update: Update, context: CallbackContext) -> None:
             ])
         else:
             reply_markup = None
-            db.tiktoks.delete_one({'message_id': int(message_id)})
+            delete_tiktok(int(message_id))
             additional_text = (
                 f"Использование тиктока от {found_tiktok['sent_at'].strftime('%d.%m.%Y')} "
                 'было удалено ✅'
@@ -478,22 +581,95 @@ def error_handler(update: Update, context: CallbackContext) -> None:
             pass
 
 
-tiktoks_handler = MessageHandler(
-    Filters.text & Filters.regex(EXTRACT_SHARE_URL_FROM_TIKTOK) & ~Filters.update.edited_message,
-    tiktok_handler
-)
-
-replies_handler = MessageHandler(
-    Filters.reply & ~Filters.update.edited_message,
-    reply_handler
-)
-
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(CommandHandler('stats', stats))
-dispatcher.add_handler(CommandHandler('watch', watch))
-dispatcher.add_handler(CommandHandler('search', search))
-dispatcher.add_handler(CallbackQueryHandler(callback))
-dispatcher.add_handler(tiktoks_handler)
-dispatcher.add_handler(replies_handler)
-dispatcher.add_error_handler(error_handler)
-updater.start_polling()
+def create_dispatcher() -> Dispatcher:
+    bot = ExtBot(
+        token=os.environ['BOT_TOKEN'],
+        defaults=Defaults(parse_mode=telegram.ParseMode.HTML),
+        request=Request(con_pool_size=DISPATCHER_WORKERS + 4)
+    )
+    dispatcher = BoundedDispatcher(
+        bot, Queue(maxsize=UPDATE_QUEUE_SIZE), workers=DISPATCHER_WORKERS, max_pending=UPDATE_QUEUE_SIZE
+    )
+    dispatcher.bot_data['outbox'] = Outbox(bot)
+
+    tiktoks_handler = MessageHandler(
+        Filters.text & Filters.regex(EXTRACT_SHARE_URL_FROM_TIKTOK) & ~Filters.update.edited_message,
+        tiktok_handler,
+        run_async=True
+    )
+
+    replies_handler = MessageHandler(
+        Filters.reply & ~Filters.update.edited_message,
+        reply_handler,
+        run_async=True
+    )
+
+    dispatcher.add_handler(CommandHandler('start', start, run_async=True))
+    dispatcher.add_handler(CommandHandler('stats', stats, run_async=True))
+    dispatcher.add_handler(CommandHandler('watch', watch, run_async=True))
+    dispatcher.add_handler(CommandHandler('search', search, run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(callback, run_async=True))
+    dispatcher.add_handler(tiktoks_handler)
+    dispatcher.add_handler(replies_handler)
+    dispatcher.add_error_handler(error_handler)
+
+    return dispatcher
+
+
+def create_app(timer: StartupTimer) -> Dispatcher:
+    with timer.phase('connect database'):
+        register_mongo_listener()
+        db.connect()
+        ensure_indexes()
+
+    with timer.phase('bootstrap derived data'):
+        if rebuilt := bootstrap_derived_collections():
+            print(f"Rebuilt {', '.join(rebuilt)}")
+
+    with timer.phase('load caches'):
+        user_directory.refresh()
+        load_known_video_ids()
+
+    with timer.phase('create dispatcher'):
+        dispatcher = create_dispatcher()
+
+    with timer.phase('set commands'):
+        if not dispatcher.bot.set_my_commands(COMMANDS):
+            raise ValueError('Error settings commands')
+
+    with timer.phase('start background workers'):
+        dispatcher.bot_data['outbox'].start()
+        start_backfill(VIDEO_ID_BACKFILL_INTERVAL_SECONDS)
+        start_known_video_ids_reload(VIDEO_ID_INDEX_RELOAD_SECONDS)
+
+    with timer.phase('start metrics server'):
+        dispatcher_queue_depth.set_function(lambda: dispatcher.update_queue.qsize() + dispatcher.pending)
+        start_metrics_server()
+
+    return dispatcher
+
+
+def main() -> None:
+    # The path is the only thing that authenticates incoming updates
+    if BOT_MODE == 'webhook' and not os.environ.get('WEBHOOK_SECRET_PATH'):
+        raise ValueError('Set WEBHOOK_SECRET_PATH to an unguessable value to run in webhook mode')
+
+    timer = StartupTimer()
+    dispatcher = create_app(timer)
+    print(f'Started in {BOT_MODE} mode\n{timer.report()}')
+
+    if BOT_MODE == 'webhook':
+        webhook_path = f"/{os.environ['WEBHOOK_SECRET_PATH']}"
+
+        if webhook_url := os.environ.get('WEBHOOK_URL'):
+            dispatcher.bot.set_webhook(f'{webhook_url.rstrip("/")}{webhook_path}', max_connections=DISPATCHER_WORKERS)
+
+        serve_webhook(dispatcher, '0.0.0.0', int(os.environ.get('PORT', 8443)), webhook_path)
+    else:
+        updater = Updater(dispatcher=dispatcher)
+        updater.start_polling()
+        updater.idle()
+
+
+if __name__ == '__main__':
+    main()
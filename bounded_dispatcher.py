@@ -0,0 +1,33 @@
+import threading
+from typing import Callable
+
+from telegram.ext import Dispatcher
+from telegram.ext.utils.promise import Promise
+
+
+class BoundedDispatcher(Dispatcher):
+    # run_async handlers are moved from update_queue into an unbounded internal
+    # queue right away, so the dispatcher thread blocks here instead and lets
+    # update_queue fill up once max_pending handlers are queued or running
+    def __init__(self, *args, max_pending: int, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.pending = 0
+        self._pending_slots = threading.BoundedSemaphore(max_pending)
+        self._pending_lock = threading.Lock()
+
+    def run_async(self, func: Callable, *args, update: object = None, **kwargs) -> Promise:
+        self._pending_slots.acquire()
+
+        with self._pending_lock:
+            self.pending += 1
+
+        def bounded_func(*func_args, **func_kwargs):
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                with self._pending_lock:
+                    self.pending -= 1
+
+                self._pending_slots.release()
+
+        return super().run_async(bounded_func, *args, update=update, **kwargs)
@@ -0,0 +1,150 @@
+from datetime import datetime
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from db import (READ_REPLIES_COLLECTION, WRITE_REPLIES_ARRAY,
+                WRITE_REPLIES_COLLECTION, db, form_db_stored_message,
+                form_db_stored_reply, form_db_stored_tiktok)
+from tiktok_utils import count_laugh_indicator
+
+
+class BulkIngestor:
+    def __init__(self, users: dict, batch_size: int = 1000) -> None:
+        self.users = users
+        self.batch_size = batch_size
+        self.round_trips = 0
+
+        self._tiktoks = {}
+        self._pending_tiktoks = {}
+        self._operations = []
+        self._reply_operations = []
+        self._replied_users = {}
+
+    def preload_tiktoks(self) -> None:
+        for tiktok in db.tiktoks.find({}, {'message_id': 1, 'sent_by_id': 1, 'sent_at': 1, 'replies.sent_by_id': 1}):
+            self._tiktoks[tiktok['message_id']] = {
+                '_id': tiktok['_id'],
+                'sent_by_id': tiktok['sent_by_id'],
+                'sent_at': tiktok['sent_at'],
+                'replied_by': {r['sent_by_id'] for r in tiktok.get('replies', [])}
+            }
+
+        self.round_trips += 1
+
+        if READ_REPLIES_COLLECTION:
+            for reply in db.replies.find({}, {'tiktok_message_id': 1, 'sent_by_id': 1}):
+                if tiktok := self._tiktoks.get(reply['tiktok_message_id']):
+                    tiktok['replied_by'].add(reply['sent_by_id'])
+
+            self.round_trips += 1
+
+    def save_sent_tiktok(self, user_id: int, message_id: int, message_sent_at: datetime,
+                         message_text: str, video_id: Optional[str]) -> None:
+        if message_id in self._tiktoks:
+            return
+
+        tiktok_id = ObjectId()
+
+        self._tiktoks[message_id] = {
+            '_id': tiktok_id, 'sent_by_id': user_id, 'sent_at': message_sent_at, 'replied_by': set()
+        }
+        self._pending_tiktoks[message_id] = (
+            tiktok_id,
+            form_db_stored_tiktok(
+                user_id, message_id, message_sent_at,
+                message_text, video_id
+            ) | ({'replies': []} if WRITE_REPLIES_ARRAY else {})
+        )
+
+        self._flush_if_full()
+
+    def save_tiktok_reply_if_applicable(self, user_id: int, replied_to_message_id: int,
+                                        message_id: int, message_sent_at: datetime,
+                                        message_text: Optional[str]) -> None:
+        tiktok = self._tiktoks.get(replied_to_message_id)
+
+        if (
+            user_id not in self.users or not tiktok
+            or tiktok['sent_by_id'] == user_id or user_id in tiktok['replied_by']
+        ):
+            return
+
+        tiktok['replied_by'].add(user_id)
+
+        reply_data = form_db_stored_message(user_id, message_id, message_sent_at, message_text)
+        reply_data['laugh_indicator'] = count_laugh_indicator(message_text)
+
+        if WRITE_REPLIES_COLLECTION:
+            stored_reply = form_db_stored_reply(
+                {'message_id': replied_to_message_id} | tiktok, reply_data
+            )
+            self._reply_operations.append(UpdateOne(
+                {'tiktok_message_id': replied_to_message_id, 'sent_by_id': user_id},
+                {'$setOnInsert': stored_reply},
+                upsert=True
+            ))
+
+        if WRITE_REPLIES_ARRAY:
+            if pending_tiktok := self._pending_tiktoks.get(replied_to_message_id):
+                pending_tiktok[1]['replies'].append(reply_data)
+            else:
+                self._operations.append(
+                    UpdateOne({'message_id': replied_to_message_id}, {'$push': {'replies': reply_data}})
+                )
+
+        replied_user = self._replied_users.setdefault(user_id, {'count': 0})
+        replied_user['count'] += 1
+        replied_user['last_replied_tiktok_id'] = tiktok['_id']
+
+        self._flush_if_full()
+
+    def flush(self) -> None:
+        operations = [
+            UpdateOne(
+                {'message_id': message_id},
+                {'$set': tiktok, '$setOnInsert': {'_id': tiktok_id}},
+                upsert=True
+            )
+            for message_id, (tiktok_id, tiktok) in self._pending_tiktoks.items()
+        ] + self._operations
+
+        self._pending_tiktoks = {}
+        self._operations = []
+
+        if operations:
+            db.tiktoks.bulk_write(operations, ordered=False)
+            self.round_trips += 1
+
+        if self._reply_operations:
+            db.replies.bulk_write(self._reply_operations, ordered=False)
+            self._reply_operations = []
+            self.round_trips += 1
+
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {'user_id': user_id},
+                {
+                    '$set': {
+                        'last_replied_at': now,
+                        'last_replied_tiktok_id': replied_user['last_replied_tiktok_id']
+                    },
+                    '$inc': {
+                        'tiktoks_replied_count': replied_user['count']
+                    }
+                }
+            )
+            for user_id, replied_user in self._replied_users.items()
+        ]
+
+        self._replied_users = {}
+
+        if operations:
+            db.users.bulk_write(operations, ordered=False)
+            self.round_trips += 1
+
+    def _flush_if_full(self) -> None:
+        if len(self._pending_tiktoks) + len(self._operations) + len(self._reply_operations) >= self.batch_size:
+            self.flush()
@@ -0,0 +1,89 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._data.get(key, MISSING)
+
+            if item is not MISSING:
+                value, expires_at = item
+
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._data[key]
+
+            self.misses += 1
+            return MISSING
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class QueryCache:
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.results = LRUCache(maxsize, ttl)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def cached(self, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper_func(*args, **kwargs) -> Any:
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            result = self.results.get(key)
+
+            if result is not MISSING:
+                return result
+
+            generation = self._generation
+            result = func(*args, **kwargs)
+
+            with self._lock:
+                # A write that happened while computing makes the result stale
+                if generation == self._generation:
+                    self.results.set(key, result)
+
+            return result
+
+        return wrapper_func
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self.results.clear()
@@ -1,15 +1,142 @@
+import itertools
 import os
-from datetime import datetime, timedelta
-from typing import Optional
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, Optional
 
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import (ASCENDING, DESCENDING, IndexModel, MongoClient,
+                     ReturnDocument, UpdateOne)
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
 
-from tiktok_utils import count_laugh_indicator
+from cache import QueryCache
+from tiktok import get_share_key
+from tiktok_utils import count_laugh_indicator, normalize_reaction
+from video_index import VideoIdIndex
 
 STRICT_MODE_START_FROM = datetime(2021, 2, 27, 0, 0, 0)
 
-client = MongoClient(os.environ['MONGO_DB_DSN'])
-db = client.tiktok
+STATS_MAX_TIME_MS = int(os.environ.get('STATS_MAX_TIME_MS', 5000))
+
+DAILY_STATS_FIELDS = (
+    'sent_count', 'got_replies_count', 'replied_count',
+    'outcome_reply_time_sum', 'outcome_laugh_indicator_sum',
+    'income_replies_count', 'income_reply_time_sum', 'income_laugh_indicator_sum',
+)
+
+# embedded keeps replies in the tiktoks array, collection in the replies collection,
+# dual writes both and reads the array while the replies are being migrated
+REPLIES_STORAGE = os.environ.get('REPLIES_STORAGE', 'embedded')
+
+if REPLIES_STORAGE not in ('embedded', 'dual', 'collection'):
+    raise ValueError(f'Unknown REPLIES_STORAGE {REPLIES_STORAGE}')
+
+READ_REPLIES_COLLECTION = REPLIES_STORAGE == 'collection'
+WRITE_REPLIES_ARRAY = REPLIES_STORAGE != 'collection'
+WRITE_REPLIES_COLLECTION = REPLIES_STORAGE != 'embedded'
+
+MINUTE_MS = 60 * 1000
+
+# Upper bounds of the reply latency histogram buckets, the last one is open
+LATENCY_BUCKETS_MS = (
+    MINUTE_MS, 5 * MINUTE_MS, 15 * MINUTE_MS, 30 * MINUTE_MS, 60 * MINUTE_MS, 3 * 60 * MINUTE_MS,
+    6 * 60 * MINUTE_MS, 12 * 60 * MINUTE_MS, 24 * 60 * MINUTE_MS, 48 * 60 * MINUTE_MS, 7 * 24 * 60 * MINUTE_MS,
+)
+
+
+class LazyDatabase:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.client = None
+        self._database = None
+        self._lock = threading.Lock()
+
+    def connect(self, dsn: Optional[str] = None, name: Optional[str] = None, **client_kwargs) -> Database:
+        with self._lock:
+            self.client = MongoClient(dsn or os.environ['MONGO_DB_DSN'], **client_kwargs)
+            self.name = name or self.name
+            self._database = self.client[self.name]
+
+        return self._database
+
+    def use(self, database: Database) -> None:
+        with self._lock:
+            self.client = database.client
+            self.name = database.name
+            self._database = database
+
+    def get(self) -> Database:
+        if self._database is None:
+            self.connect()
+
+        return self._database
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, name: str):
+        return self.get()[name]
+
+
+db = LazyDatabase(os.environ.get('MONGO_DB_NAME', 'tiktok'))
+
+query_cache = QueryCache(
+    maxsize=int(os.environ.get('QUERY_CACHE_SIZE', 256)),
+    ttl=int(os.environ.get('QUERY_CACHE_TTL_SECONDS', 300))
+)
+
+known_video_ids = VideoIdIndex()
+
+INDEXES = {
+    'tiktoks': [
+        IndexModel([('message_id', ASCENDING)], unique=True),
+        IndexModel([('video_id', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('share_key', ASCENDING)]),
+        IndexModel([('sent_at', ASCENDING)]),
+        IndexModel([('sent_by_id', ASCENDING), ('sent_at', ASCENDING)]),
+        IndexModel([('replies.sent_by_id', ASCENDING)]),
+    ],
+    'replies': [
+        IndexModel([('tiktok_message_id', ASCENDING), ('sent_by_id', ASCENDING)], unique=True),
+        IndexModel([('sent_by_id', ASCENDING), ('sent_at', ASCENDING)]),
+    ],
+    'users': [
+        IndexModel([('user_id', ASCENDING)]),
+    ],
+    'not_answered_tiktoks': [
+        IndexModel([('user_id', ASCENDING), ('message_id', ASCENDING)], unique=True),
+        IndexModel([('user_id', ASCENDING), ('sent_at', ASCENDING), ('message_id', ASCENDING)]),
+        IndexModel([('message_id', ASCENDING)]),
+    ],
+    'daily_stats': [
+        IndexModel([('user_id', ASCENDING), ('day', ASCENDING)], unique=True),
+        IndexModel([('day', ASCENDING)]),
+    ],
+    'reactions': [
+        IndexModel([('user_id', ASCENDING), ('key', ASCENDING)], unique=True),
+        IndexModel([('user_id', ASCENDING), ('frequency', DESCENDING)]),
+    ],
+    'daily_reactions': [
+        IndexModel([('user_id', ASCENDING), ('day', ASCENDING), ('key', ASCENDING)], unique=True),
+    ],
+    'interactions': [
+        IndexModel([('sender_id', ASCENDING), ('replier_id', ASCENDING), ('day', ASCENDING)], unique=True),
+        IndexModel([('replier_id', ASCENDING), ('day', ASCENDING)]),
+        IndexModel([('day', ASCENDING)]),
+    ],
+    'resolved_share_urls': [
+        IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0),
+    ],
+}
+
+
+def ensure_indexes() -> None:
+    for collection_name, indexes in INDEXES.items():
+        db[collection_name].create_indexes(indexes)
 
 
 def form_db_stored_message(user_id: int, message_id: int, message_sent_at: datetime,
@@ -23,30 +150,157 @@ def form_db_stored_message(user_id: int, message_id: int, message_sent_at: datet
     }
 
 
+def form_db_stored_tiktok(user_id: int, message_id: int, message_sent_at: datetime,
+                          message_text: str, video_id: Optional[str]) -> dict:
+    return form_db_stored_message(
+        user_id, message_id, message_sent_at, message_text, video_id
+    ) | {'share_key': get_share_key(message_text)}
+
+
+def form_db_stored_reply(tiktok: dict, reply: dict) -> dict:
+    return {
+        'tiktok_message_id': tiktok['message_id'],
+        'tiktok_sent_by_id': tiktok['sent_by_id'],
+        'tiktok_sent_at': tiktok['sent_at']
+    } | reply
+
+
 def save_sent_tiktok(user_id: int, message_id: int, message_sent_at: datetime,
-                     message_text: str, video_id: Optional[str]) -> dict:
-    res = db.tiktoks.update_one(
+                     message_text: str, video_id: Optional[str]) -> Optional[dict]:
+    update = {
+        '$set': form_db_stored_tiktok(
+            user_id, message_id, message_sent_at,
+            message_text, video_id
+        )
+    }
+
+    if WRITE_REPLIES_ARRAY:
+        update['$setOnInsert'] = {'replies': []}
+
+    res = db.tiktoks.update_one({'message_id': message_id}, update, upsert=True)
+
+    if not res.upserted_id:
+        return None
+
+    if video_id:
+        known_video_ids.add(video_id)
+
+    _add_not_answered_tiktok(user_id, message_id, message_sent_at)
+    _apply_daily_stats_changes(
+        [(user_id, _get_day_beginning(message_sent_at), {'sent_count': 1})]
+    )
+    sent_user = _increment_sent_tiktoks_counters(user_id, message_sent_at, 1)
+
+    query_cache.invalidate()
+
+    return sent_user
+
+
+def set_tiktok_video_id(message_id: int, video_id: str) -> None:
+    db.tiktoks.update_one(
         {'message_id': message_id},
-        {
-            '$set': form_db_stored_message(
-                user_id, message_id, message_sent_at,
-                message_text, video_id
-            ) | {'replies': []},
-        },
-        upsert=True
+        {'$set': {'video_id': video_id}}
+    )
+
+    known_video_ids.add(video_id)
+    query_cache.invalidate()
+
+
+def delete_tiktok(message_id: int) -> Optional[dict]:
+    deleted_tiktok = db.tiktoks.find_one_and_delete({'message_id': message_id})
+
+    if deleted_tiktok:
+        if READ_REPLIES_COLLECTION:
+            deleted_tiktok['replies'] = list(db.replies.find({'tiktok_message_id': message_id}))
+
+        if WRITE_REPLIES_COLLECTION:
+            db.replies.delete_many({'tiktok_message_id': message_id})
+
+        if deleted_tiktok.get('video_id'):
+            known_video_ids.remove(deleted_tiktok['video_id'])
+
+        db.not_answered_tiktoks.delete_many({'message_id': message_id})
+        _apply_daily_stats_changes(_get_tiktok_daily_stats_changes(deleted_tiktok), sign=-1)
+        _apply_reactions_changes(_get_tiktok_reactions_changes(deleted_tiktok), sign=-1)
+        _apply_interactions_changes(_get_tiktok_interactions_changes(deleted_tiktok), sign=-1)
+        _increment_sent_tiktoks_counters(deleted_tiktok['sent_by_id'], deleted_tiktok['sent_at'], -1)
+
+        query_cache.invalidate()
+
+    return deleted_tiktok
+
+
+def _increment_sent_tiktoks_counters(user_id: int, sent_at: datetime, increment: int) -> Optional[dict]:
+    day = _get_day_beginning(sent_at)
+    is_same_day = {'$eq': ['$tiktoks_sent_today_date', day]}
+    # A missing date sorts before any day, older days don't touch the today counter
+    is_new_day = {'$gt': [day, '$tiktoks_sent_today_date']} if increment > 0 else False
+
+    return db.users.find_one_and_update(
+        {'user_id': user_id},
+        [
+            {
+                '$set': {
+                    'tiktoks_sent_count': {
+                        '$add': [{'$ifNull': ['$tiktoks_sent_count', 0]}, increment]
+                    },
+                    'tiktoks_sent_today_count': {
+                        '$switch': {
+                            'branches': [
+                                {'case': is_same_day, 'then': {'$add': ['$tiktoks_sent_today_count', increment]}},
+                                {'case': is_new_day, 'then': increment}
+                            ],
+                            'default': '$tiktoks_sent_today_count'
+                        }
+                    },
+                    'tiktoks_sent_today_date': {'$cond': [is_new_day, day, '$tiktoks_sent_today_date']}
+                }
+            }
+        ],
+        return_document=ReturnDocument.AFTER
     )
 
-    return db.tiktoks.find_one({'_id': res.upserted_id})
+
+def rebuild_sent_tiktoks_counters() -> None:
+    today = _get_day_beginning(datetime.utcnow())
+    sent_stats = get_sent_tiktoks_stats()
+    today_sent_stats = {
+        d['_id']: d['sent_count'] for d in db.tiktoks.aggregate([
+            {'$match': {'sent_at': {'$gte': today}}},
+            {'$group': {'_id': '$sent_by_id', 'sent_count': {'$sum': 1}}}
+        ])
+    }
+
+    operations = [
+        UpdateOne(
+            {'user_id': user_id},
+            {
+                '$set': {
+                    'tiktoks_sent_count': sent_stats.get(user_id, {}).get('sent_count', 0),
+                    'tiktoks_sent_today_count': today_sent_stats.get(user_id, 0),
+                    'tiktoks_sent_today_date': today
+                }
+            }
+        )
+        for user_id in db.users.distinct('user_id')
+    ]
+
+    if operations:
+        db.users.bulk_write(operations, ordered=False)
 
 
 def save_tiktok_reply_if_applicable(replied_user: dict, replied_to_message_id: int,
                                     message_id: int, message_sent_at: datetime,
                                     message_text: Optional[str]) -> None:
-    not_yet_replied_tiktok = db.tiktoks.find_one({
+    query = {
         'message_id': replied_to_message_id,
-        'sent_by_id': {'$ne': replied_user['user_id']},
-        'replies.sent_by_id': {'$ne': replied_user['user_id']}
-    })
+        'sent_by_id': {'$ne': replied_user['user_id']}
+    }
+
+    if not READ_REPLIES_COLLECTION:
+        query['replies.sent_by_id'] = {'$ne': replied_user['user_id']}
+
+    not_yet_replied_tiktok = db.tiktoks.find_one(query, {'replies': {'$slice': 1}})
 
     if not not_yet_replied_tiktok:
         return
@@ -57,14 +311,44 @@ def save_tiktok_reply_if_applicable(replied_user: dict, replied_to_message_id: i
 
     reply_data['laugh_indicator'] = count_laugh_indicator(message_text)
 
-    db.tiktoks.update_one(
-        {'message_id': not_yet_replied_tiktok['message_id']},
-        {
-            '$push': {
-                'replies': reply_data
+    if READ_REPLIES_COLLECTION:
+        is_first_reply = not db.replies.count_documents({'tiktok_message_id': replied_to_message_id}, limit=1)
+    else:
+        is_first_reply = not not_yet_replied_tiktok.get('replies')
+
+    if WRITE_REPLIES_COLLECTION:
+        try:
+            db.replies.insert_one(form_db_stored_reply(not_yet_replied_tiktok, reply_data))
+        except DuplicateKeyError:
+            return
+
+    # Concurrent replies from the same user must not reach the derived collections twice
+    if WRITE_REPLIES_ARRAY:
+        res = db.tiktoks.update_one(
+            {
+                'message_id': not_yet_replied_tiktok['message_id'],
+                'replies.sent_by_id': {'$ne': replied_user['user_id']}
+            },
+            {
+                '$push': {
+                    'replies': reply_data
+                }
             }
-        }
-    )
+        )
+
+        if not res.modified_count:
+            return
+
+    db.not_answered_tiktoks.delete_one({
+        'user_id': replied_user['user_id'],
+        'message_id': not_yet_replied_tiktok['message_id']
+    })
+
+    _apply_daily_stats_changes(_get_reply_daily_stats_changes(
+        not_yet_replied_tiktok, reply_data, is_first_reply
+    ))
+    _apply_reactions_changes(_get_reply_reactions_changes(not_yet_replied_tiktok, reply_data))
+    _apply_interactions_changes(_get_reply_interactions_changes(not_yet_replied_tiktok, reply_data))
 
     db.users.update_one(
         {'user_id': replied_user['user_id']},
@@ -79,21 +363,201 @@ def save_tiktok_reply_if_applicable(replied_user: dict, replied_to_message_id: i
         }
     )
 
+    query_cache.invalidate()
+
+
+def get_not_answered_tiktoks_summary(user_id: int,
+                                     offset_from_now: Optional[timedelta] = None) -> tuple[int, Optional[int]]:
+    query = {'user_id': user_id}
 
-def get_not_answered_tiktoks(user_id: int, offset_from_now: Optional[timedelta] = None) -> Optional[dict]:
-    query = {
-        'sent_by_id': {"$ne": user_id},
-        'sent_at': {'$gte': STRICT_MODE_START_FROM},
-        'replies.sent_by_id': {'$ne': user_id}
-    }
     if offset_from_now:
-        query['sent_at']['$lte'] = datetime.utcnow() - offset_from_now
+        query['sent_at'] = {'$lte': datetime.utcnow() - offset_from_now}
+
+    count = db.not_answered_tiktoks.count_documents(query)
+
+    if not count:
+        return 0, None
+
+    oldest = db.not_answered_tiktoks.find_one(
+        query, {'_id': 0, 'message_id': 1}, sort=[('sent_at', ASCENDING)]
+    )
+
+    return count, oldest['message_id'] if oldest else None
 
-    return list(db.tiktoks.find(query).sort('sent_at', 1))
+
+def rebuild_not_answered_tiktoks(batch_size: int = 1000) -> None:
+    user_ids = db.users.distinct('user_id')
+    tiktoks = _iter_tiktoks(
+        {'sent_at': {'$gte': STRICT_MODE_START_FROM}},
+        {'message_id': 1, 'sent_at': 1, 'sent_by_id': 1, 'replies.sent_by_id': 1},
+        batch_size=batch_size
+    )
+
+    def iter_documents() -> Iterator[dict]:
+        for tiktok in tiktoks:
+            replied_by = {r['sent_by_id'] for r in tiktok.get('replies', [])}
+            yield from (
+                {'user_id': user_id, 'message_id': tiktok['message_id'], 'sent_at': tiktok['sent_at']}
+                for user_id in user_ids
+                if user_id != tiktok['sent_by_id'] and user_id not in replied_by
+            )
+
+    _replace_collection('not_answered_tiktoks', iter_documents(), batch_size)
+
+
+def _replace_collection(name: str, documents: Iterable[dict], batch_size: int) -> None:
+    # Built aside and swapped in at once, so live upserts can't collide with the
+    # rebuilt documents and readers never see a half filled collection
+    staging = db[f'{name}_rebuild']
+    staging.drop()
+    staging.create_indexes(INDEXES[name])
+    documents = iter(documents)
+
+    while batch := list(itertools.islice(documents, batch_size)):
+        staging.insert_many(batch, ordered=False)
+
+    staging.rename(name, dropTarget=True)
+
+
+def _add_not_answered_tiktok(sent_by_id: int, message_id: int, message_sent_at: datetime) -> None:
+    if message_sent_at.replace(tzinfo=None) < STRICT_MODE_START_FROM:
+        return
+
+    operations = [
+        UpdateOne(
+            {'user_id': user_id, 'message_id': message_id},
+            {'$setOnInsert': {'sent_at': message_sent_at}},
+            upsert=True
+        )
+        for user_id in db.users.distinct('user_id')
+        if user_id != sent_by_id
+    ]
+
+    if operations:
+        db.not_answered_tiktoks.bulk_write(operations, ordered=False)
+
+
+@query_cache.cached
+def get_stats_summary(start_date: Optional[datetime] = None) -> dict:
+    query = [
+        {
+            '$group': {
+                '_id': '$user_id',
+                **{field: {'$sum': f'${field}'} for field in DAILY_STATS_FIELDS}
+            }
+        }
+    ]
+
+    if start_date:
+        query.insert(0, {'$match': {'day': {'$gte': _get_day_beginning(start_date)}}})
+
+    summary = {'sent': {}, 'outcome': {}, 'income': {}}
+
+    for d in db.daily_stats.aggregate(query, maxTimeMS=STATS_MAX_TIME_MS):
+        if d['sent_count']:
+            summary['sent'][d['_id']] = {
+                '_id': d['_id'],
+                'sent_count': d['sent_count'],
+                'got_replies_count': d['got_replies_count']
+            }
+
+        if d['replied_count']:
+            summary['outcome'][d['_id']] = {
+                '_id': d['_id'],
+                'replied_count': d['replied_count'],
+                'avg_reply_time': d['outcome_reply_time_sum'] / d['replied_count'],
+                'avg_laugh_indicator': d['outcome_laugh_indicator_sum'] / d['replied_count']
+            }
+
+        if d['income_replies_count']:
+            summary['income'][d['_id']] = {
+                '_id': d['_id'],
+                'replied_count': d['income_replies_count'],
+                'avg_reply_time': d['income_reply_time_sum'] / d['income_replies_count'],
+                'avg_laugh_indicator': d['income_laugh_indicator_sum'] / d['income_replies_count']
+            }
+
+    return summary
+
+
+def rebuild_daily_stats(batch_size: int = 1000) -> None:
+    daily_stats = defaultdict(Counter)
+    tiktoks = _iter_tiktoks(
+        {},
+        {
+            'sent_by_id': 1, 'sent_at': 1, 'replies.sent_by_id': 1,
+            'replies.sent_at': 1, 'replies.laugh_indicator': 1
+        },
+        batch_size=batch_size
+    )
+
+    for tiktok in tiktoks:
+        for user_id, day, changes in _get_tiktok_daily_stats_changes(tiktok):
+            daily_stats[(user_id, day)].update(changes)
+
+    _replace_collection('daily_stats', (
+        {'user_id': user_id, 'day': day} | {field: changes[field] for field in DAILY_STATS_FIELDS}
+        for (user_id, day), changes in daily_stats.items()
+    ), batch_size)
+
+
+def _get_tiktok_daily_stats_changes(tiktok: dict) -> list[tuple[int, datetime, dict]]:
+    replies = [r for r in tiktok.get('replies', []) if r['sent_by_id'] != tiktok['sent_by_id']]
+    changes = [(
+        tiktok['sent_by_id'], _get_day_beginning(tiktok['sent_at']),
+        {'sent_count': 1, 'got_replies_count': int(bool(replies))}
+    )]
+
+    for reply in replies:
+        changes.extend(_get_reply_daily_stats_changes(tiktok, reply, is_first_reply=False))
+
+    return changes
+
+
+def _get_reply_daily_stats_changes(tiktok: dict, reply: dict,
+                                   is_first_reply: bool) -> list[tuple[int, datetime, dict]]:
+    day = _get_day_beginning(tiktok['sent_at'])
+    reply_time = _get_reply_time(tiktok, reply)
+    laugh_indicator = reply.get('laugh_indicator') or 0
+
+    return [
+        (
+            reply['sent_by_id'], day,
+            {
+                'replied_count': 1,
+                'outcome_reply_time_sum': reply_time,
+                'outcome_laugh_indicator_sum': laugh_indicator
+            }
+        ),
+        (
+            tiktok['sent_by_id'], day,
+            {
+                'got_replies_count': int(is_first_reply),
+                'income_replies_count': 1,
+                'income_reply_time_sum': reply_time,
+                'income_laugh_indicator_sum': laugh_indicator
+            }
+        )
+    ]
+
+
+def _apply_daily_stats_changes(changes: list[tuple[int, datetime, dict]], sign: int = 1) -> None:
+    operations = [
+        UpdateOne(
+            {'user_id': user_id, 'day': day},
+            {'$inc': {field: value * sign for field, value in day_changes.items()}},
+            upsert=True
+        )
+        for user_id, day, day_changes in changes
+    ]
+
+    if operations:
+        db.daily_stats.bulk_write(operations, ordered=False)
 
 
 def get_sent_tiktoks_stats(start_date: Optional[datetime] = None) -> dict:
     query = [
+        *_replies_lookup_stages(),
         {
             '$set': {
                 'replied': {
@@ -122,11 +586,19 @@ def get_sent_tiktoks_stats(start_date: Optional[datetime] = None) -> dict:
     return {d['_id']: d for d in db.tiktoks.aggregate(_add_date_filter_if_provided(query, start_date))}
 
 
-def get_outcome_replies_tiktoks_stats(start_date: Optional[datetime] = None) -> dict:
+def compute_stats_summary(start_date: Optional[datetime] = None) -> dict:
+    reply_groups = {
+        'replied_count': {'$sum': 1},
+        'avg_reply_time': {'$avg': '$reply_time'},
+        'avg_laugh_indicator': {'$avg': '$replies.laugh_indicator'}
+    }
     query = [
+        *_replies_lookup_stages(),
         {
             '$unwind': {
-                'path': '$replies'
+                'path': '$replies',
+                'preserveNullAndEmptyArrays': True,
+                'includeArrayIndex': 'reply_index'
             }
         }, {
             '$set': {
@@ -140,159 +612,269 @@ def get_outcome_replies_tiktoks_stats(start_date: Optional[datetime] = None) ->
                 }
             }
         }, {
-            '$match': {
-                'own_reply': False
-            }
-        }, {
-            '$group': {
-                '_id': '$replies.sent_by_id',
-                'replied_count': {'$sum': 1},
-                'avg_outcome_reply_time': {
-                    '$avg': '$reply_time'
-                },
-                'avg_outcome_laugh_indicator': {
-                    '$avg': '$replies.laugh_indicator'
-                }
+            '$facet': {
+                'sent': [
+                    {
+                        '$match': {'reply_index': {'$in': [None, 0]}}
+                    }, {
+                        '$group': {
+                            '_id': '$sent_by_id',
+                            'sent_count': {'$sum': 1},
+                            'got_replies_count': {
+                                '$sum': {'$cond': [{'$eq': ['$reply_index', 0]}, 1, 0]}
+                            }
+                        }
+                    }
+                ],
+                'outcome': [
+                    {
+                        '$match': {'reply_index': {'$ne': None}, 'own_reply': False}
+                    }, {
+                        '$group': {'_id': '$replies.sent_by_id'} | reply_groups
+                    }
+                ],
+                'income': [
+                    {
+                        '$match': {'reply_index': {'$ne': None}, 'own_reply': False}
+                    }, {
+                        '$group': {'_id': '$sent_by_id'} | reply_groups
+                    }
+                ]
             }
         }
     ]
-    return {d['_id']: d for d in db.tiktoks.aggregate(_add_date_filter_if_provided(query, start_date))}
 
+    summary = next(db.tiktoks.aggregate(
+        _add_date_filter_if_provided(query, start_date),
+        maxTimeMS=STATS_MAX_TIME_MS,
+        allowDiskUse=True
+    ))
+
+    return {facet: {d['_id']: d for d in stats} for facet, stats in summary.items()}
+
+
+@query_cache.cached
+def get_interactions(start_date: Optional[datetime] = None, sender_id: Optional[int] = None,
+                     replier_id: Optional[int] = None) -> dict[tuple[int, int], dict]:
+    match = {}
+
+    if sender_id is not None:
+        match['sender_id'] = sender_id
+
+    if replier_id is not None:
+        match['replier_id'] = replier_id
+
+    if start_date:
+        match['day'] = {'$gte': _get_day_beginning(start_date)}
 
-def get_income_replies_stats(start_date: Optional[datetime] = None) -> dict:
     query = [
+        {'$match': match},
         {
-            '$unwind': {
-                'path': '$replies'
-            }
-        }, {
-            '$set': {
-                'reply_time': {
-                    '$subtract': [
-                        '$replies.sent_at', '$sent_at'
-                    ]
-                },
-                'own_reply': {
-                    '$eq': ['$replies.sent_by_id', '$sent_by_id']
-                }
-            }
-        }, {
-            '$match': {
-                'own_reply': False
-            }
-        }, {
             '$group': {
-                '_id': '$sent_by_id',
-                'avg_income_reply_time': {
-                    '$avg': '$reply_time'
-                },
-                'avg_income_laugh_indicator': {
-                    '$avg': '$replies.laugh_indicator'
-                }
+                '_id': {'sender_id': '$sender_id', 'replier_id': '$replier_id'},
+                'replies_count': {'$sum': '$replies_count'},
+                'reply_time_sum': {'$sum': '$reply_time_sum'},
+                'laugh_indicator_sum': {'$sum': '$laugh_indicator_sum'},
+            } | {
+                f'latency_{i}': {'$sum': f'$latency_histogram.{i}'}
+                for i in range(len(LATENCY_BUCKETS_MS) + 1)
             }
-        }
+        },
+        {'$match': {'replies_count': {'$gt': 0}}}
     ]
-    return {d['_id']: d for d in db.tiktoks.aggregate(_add_date_filter_if_provided(query, start_date))}
 
+    return {
+        (d['_id']['sender_id'], d['_id']['replier_id']): {
+            'replies_count': d['replies_count'],
+            'avg_reply_time': d['reply_time_sum'] / d['replies_count'],
+            'median_reply_time': _get_histogram_median(
+                [d[f'latency_{i}'] for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+            ),
+            'avg_laugh_indicator': d['laugh_indicator_sum'] / d['replies_count']
+        }
+        for d in db.interactions.aggregate(query)
+    }
 
-def get_personal_income_stats(user_id: int, start_date: Optional[datetime] = None) -> list:
-    query = [
+
+def get_personal_income_stats(user_id: int, start_date: Optional[datetime] = None) -> dict[int, dict]:
+    return {
+        replier_id: stats
+        for (_, replier_id), stats in get_interactions(start_date, sender_id=user_id).items()
+    }
+
+
+def get_personal_outcome_stats(user_id: int, start_date: Optional[datetime] = None) -> dict[int, dict]:
+    return {
+        sender_id: stats
+        for (sender_id, _), stats in get_interactions(start_date, replier_id=user_id).items()
+    }
+
+
+def rebuild_interactions(batch_size: int = 1000) -> None:
+    interactions = defaultdict(Counter)
+    tiktoks = _iter_tiktoks(
+        {},
         {
-            '$match': {
-                'sent_by_id': user_id
-            }
-        }, {
-            '$unwind': {
-                'path': '$replies'
-            }
-        }, {
-            '$match': {
-                '$replies.sent_by_id': {'$ne': user_id}
-            }
-        }, {
-            '$set': {
-                'reply_time': {
-                    '$subtract': [
-                        '$replies.sent_at', '$sent_at'
-                    ]
-                }
-            }
-        }, {
-            '$group': {
-                '_id': '$replies.sent_by_id',
-                'replied_count': {'$sum': 1},
-                'avg_income_reply_time': {
-                    '$avg': '$reply_time'
-                },
-                'avg_income_laugh_indicator': {
-                    '$avg': '$replies.laugh_indicator'
-                }
-            }
-        }
-    ]
-    return list(db.tiktoks.aggregate(_add_date_filter_if_provided(query, start_date)))
+            'sent_by_id': 1, 'sent_at': 1, 'replies.sent_by_id': 1,
+            'replies.sent_at': 1, 'replies.laugh_indicator': 1
+        },
+        batch_size=batch_size,
+        only_replied=True
+    )
 
+    for tiktok in tiktoks:
+        for sender_id, replier_id, day, changes in _get_tiktok_interactions_changes(tiktok):
+            interactions[(sender_id, replier_id, day)].update(changes)
 
-def get_personal_outcome_stats(user_id: int, start_date: Optional[datetime] = None) -> list:
-    query = [
+    _replace_collection('interactions', (
         {
-            '$match': {
-                'sent_by_id': {
-                    '$ne': user_id
-                },
-                'replies.sent_by_id': user_id
-            }
-        }, {
-            '$unwind': {
-                'path': '$replies'
-            }
-        }, {
-            '$group': {
-                '_id': '$sent_by_id',
-                'replied_count': {
-                    '$sum': 1
-                },
-                'avg_income_reply_time': {
-                    '$avg': '$reply_time'
-                },
-                'avg_income_laugh_indicator': {
-                    '$avg': '$replies.laugh_indicator'
-                }
+            'sender_id': sender_id, 'replier_id': replier_id, 'day': day,
+            'replies_count': changes['replies_count'],
+            'reply_time_sum': changes['reply_time_sum'],
+            'laugh_indicator_sum': changes['laugh_indicator_sum'],
+            'latency_histogram': {
+                field.removeprefix('latency_histogram.'): value
+                for field, value in changes.items() if field.startswith('latency_histogram.')
             }
         }
+        for (sender_id, replier_id, day), changes in interactions.items()
+    ), batch_size)
+
+
+def _get_tiktok_interactions_changes(tiktok: dict) -> list[tuple[int, int, datetime, dict]]:
+    return [
+        change
+        for reply in tiktok.get('replies', []) if reply['sent_by_id'] != tiktok['sent_by_id']
+        for change in _get_reply_interactions_changes(tiktok, reply)
     ]
-    return list(db.tiktoks.aggregate(_add_date_filter_if_provided(query, start_date)))
 
 
-def get_top_most_popular_reactions(user_id: int, start_date: Optional[datetime] = None) -> list:
-    query = [
+def _get_reply_interactions_changes(tiktok: dict, reply: dict) -> list[tuple[int, int, datetime, dict]]:
+    reply_time = _get_reply_time(tiktok, reply)
+    bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if reply_time < bound), len(LATENCY_BUCKETS_MS))
+
+    return [(
+        tiktok['sent_by_id'], reply['sent_by_id'], _get_day_beginning(tiktok['sent_at']),
         {
-            '$match': {
-                'sent_by_id': {
-                    '$ne': user_id
-                },
-                'replies.sent_by_id': user_id
-            }
-        }, {
-            '$unwind': {
-                'path': '$replies'
-            }
-        }, {
-            '$group': {
-                '_id': '$replies.text',
-                'frequency': {
-                    '$sum': 1
-                }
-            }
-        }, {
-            '$sort': {
-                'frequency': -1
-            }
-        }, {
-            '$limit': 10
+            'replies_count': 1,
+            'reply_time_sum': reply_time,
+            'laugh_indicator_sum': reply.get('laugh_indicator') or 0,
+            f'latency_histogram.{bucket}': 1
         }
+    )]
+
+
+def _apply_interactions_changes(changes: list[tuple[int, int, datetime, dict]], sign: int = 1) -> None:
+    operations = [
+        UpdateOne(
+            {'sender_id': sender_id, 'replier_id': replier_id, 'day': day},
+            {'$inc': {field: value * sign for field, value in day_changes.items()}},
+            upsert=True
+        )
+        for sender_id, replier_id, day, day_changes in changes
     ]
-    return list(db.tiktoks.aggregate(_add_date_filter_if_provided(query, start_date)))
+
+    if operations:
+        db.interactions.bulk_write(operations, ordered=False)
+
+
+def _get_histogram_median(counts: list[int]) -> Optional[float]:
+    total = sum(counts)
+
+    if not total:
+        return None
+
+    middle = total / 2
+    lower_bound = 0
+
+    for i, count in enumerate(counts):
+        if i == len(LATENCY_BUCKETS_MS):
+            return lower_bound
+
+        upper_bound = LATENCY_BUCKETS_MS[i]
+
+        if count and middle <= count:
+            return lower_bound + (upper_bound - lower_bound) * middle / count
+
+        middle -= count
+        lower_bound = upper_bound
+
+    return lower_bound
+
+
+@query_cache.cached
+def get_top_most_popular_reactions(user_id: int, start_date: Optional[datetime] = None, limit: int = 10) -> list:
+    if start_date:
+        return list(db.daily_reactions.aggregate([
+            {'$match': {'user_id': user_id, 'day': {'$gte': _get_day_beginning(start_date)}}},
+            {'$group': {'_id': '$key', 'frequency': {'$sum': '$frequency'}}},
+            {'$match': {'frequency': {'$gt': 0}}},
+            {'$sort': {'frequency': -1, '_id': 1}},
+            {'$limit': limit}
+        ]))
+
+    reactions = (
+        db.reactions.find({'user_id': user_id, 'frequency': {'$gt': 0}}, {'_id': 0, 'key': 1, 'frequency': 1})
+        .sort('frequency', DESCENDING)
+        .limit(limit)
+    )
+
+    return [{'_id': r['key'], 'frequency': r['frequency']} for r in reactions]
+
+
+def rebuild_reactions(batch_size: int = 1000) -> None:
+    reactions = Counter()
+    daily_reactions = Counter()
+    tiktoks = _iter_tiktoks(
+        {},
+        {'sent_by_id': 1, 'sent_at': 1, 'replies.sent_by_id': 1, 'replies.text': 1},
+        batch_size=batch_size,
+        only_replied=True
+    )
+
+    for tiktok in tiktoks:
+        for user_id, day, key in _get_tiktok_reactions_changes(tiktok):
+            reactions[(user_id, key)] += 1
+            daily_reactions[(user_id, day, key)] += 1
+
+    _replace_collection('reactions', (
+        {'user_id': user_id, 'key': key, 'frequency': frequency}
+        for (user_id, key), frequency in reactions.items()
+    ), batch_size)
+    _replace_collection('daily_reactions', (
+        {'user_id': user_id, 'day': day, 'key': key, 'frequency': frequency}
+        for (user_id, day, key), frequency in daily_reactions.items()
+    ), batch_size)
+
+
+def _get_tiktok_reactions_changes(tiktok: dict) -> list[tuple[int, datetime, str]]:
+    return [
+        change
+        for reply in tiktok.get('replies', []) if reply['sent_by_id'] != tiktok['sent_by_id']
+        for change in _get_reply_reactions_changes(tiktok, reply)
+    ]
+
+
+def _get_reply_reactions_changes(tiktok: dict, reply: dict) -> list[tuple[int, datetime, str]]:
+    if not (key := normalize_reaction(reply.get('text'))):
+        return []
+
+    return [(reply['sent_by_id'], _get_day_beginning(tiktok['sent_at']), key)]
+
+
+def _apply_reactions_changes(changes: list[tuple[int, datetime, str]], sign: int = 1) -> None:
+    if not changes:
+        return
+
+    db.reactions.bulk_write([
+        UpdateOne({'user_id': user_id, 'key': key}, {'$inc': {'frequency': sign}}, upsert=True)
+        for user_id, _, key in changes
+    ], ordered=False)
+
+    db.daily_reactions.bulk_write([
+        UpdateOne({'user_id': user_id, 'day': day, 'key': key}, {'$inc': {'frequency': sign}}, upsert=True)
+        for user_id, day, key in changes
+    ], ordered=False)
 
 
 def get_today_sent_tiktoks_count(user_id: int) -> int:
@@ -307,13 +889,280 @@ def get_today_sent_tiktoks_count(user_id: int) -> int:
     return db.tiktoks.count_documents(query)
 
 
-def get_tiktoks_with_same_video_id(user_id: int, video_id: str) -> int:
-    query = [
+def get_cached_video_id(share_url: str) -> Optional[dict]:
+    return db.resolved_share_urls.find_one({
+        '_id': share_url,
+        'expires_at': {'$gt': datetime.utcnow()}
+    })
+
+
+def save_cached_video_id(share_url: str, video_id: Optional[str], ttl: timedelta) -> None:
+    now = datetime.utcnow()
+
+    db.resolved_share_urls.update_one(
+        {'_id': share_url},
         {
-            '$match': {
-                'video_id': video_id
+            '$set': {
+                'video_id': video_id,
+                'resolved_at': now,
+                'expires_at': now + ttl
             }
         },
+        upsert=True
+    )
+
+
+def get_export_checkpoint(chat_id: int) -> Optional[dict]:
+    return db.export_checkpoints.find_one({'_id': chat_id})
+
+
+def save_export_checkpoint(chat_id: int, last_message_id: int,
+                           migrated_from_chat_id: Optional[int] = None) -> None:
+    db.export_checkpoints.update_one(
+        {'_id': chat_id},
+        {
+            '$set': {
+                'last_message_id': last_message_id,
+                'migrated_from_chat_id': migrated_from_chat_id,
+                'updated_at': datetime.utcnow()
+            }
+        },
+        upsert=True
+    )
+
+
+def get_backfill_checkpoint(name: str) -> Optional[dict]:
+    return db.backfill_checkpoints.find_one({'_id': name})
+
+
+def save_backfill_checkpoint(name: str, last_id: ObjectId) -> None:
+    db.backfill_checkpoints.update_one(
+        {'_id': name},
+        {'$set': {'last_id': last_id, 'updated_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+
+def delete_backfill_checkpoint(name: str) -> None:
+    db.backfill_checkpoints.delete_one({'_id': name})
+
+
+def iter_tiktoks_with_replies(after_id: Optional[ObjectId] = None, batch_size: int = 1000) -> Iterator[dict]:
+    query = {}
+
+    if after_id:
+        query['_id'] = {'$gt': after_id}
+
+    return _iter_tiktoks(
+        query,
+        {'message_id': 1, 'replies.sent_by_id': 1, 'replies.text': 1, 'replies.laugh_indicator': 1},
+        batch_size=batch_size,
+        only_replied=True
+    )
+
+
+def get_reply_fields_changes(tiktok: dict) -> dict[str, tuple]:
+    changes = {}
+
+    for i, reply in enumerate(tiktok['replies']):
+        laugh_indicator = count_laugh_indicator(reply.get('text'))
+
+        if reply.get('laugh_indicator') != laugh_indicator:
+            changes[f'replies.{i}.laugh_indicator'] = (reply.get('laugh_indicator'), laugh_indicator)
+
+    return changes
+
+
+def save_reply_fields_changes(changes: list[tuple[dict, dict[str, tuple]]]) -> int:
+    if not changes:
+        return 0
+
+    modified_count = 0
+
+    if WRITE_REPLIES_ARRAY:
+        # Replies are only ever appended, so an unchanged array size keeps the positional paths valid
+        result = db.tiktoks.bulk_write([
+            UpdateOne(
+                {'_id': tiktok['_id'], 'replies': {'$size': len(tiktok['replies'])}},
+                {'$set': {field: new for field, (_, new) in tiktok_changes.items()}}
+            )
+            for tiktok, tiktok_changes in changes
+        ], ordered=False)
+        modified_count = result.modified_count
+
+    if WRITE_REPLIES_COLLECTION:
+        operations = []
+
+        for tiktok, tiktok_changes in changes:
+            for field, (_, new) in tiktok_changes.items():
+                _, i, reply_field = field.split('.')
+                operations.append(UpdateOne(
+                    {'tiktok_message_id': tiktok['message_id'], 'sent_by_id': tiktok['replies'][int(i)]['sent_by_id']},
+                    {'$set': {reply_field: new}}
+                ))
+
+        result = db.replies.bulk_write(operations, ordered=False)
+
+        if READ_REPLIES_COLLECTION:
+            modified_count = result.modified_count
+
+    query_cache.invalidate()
+
+    return modified_count
+
+
+def iter_tiktoks_with_embedded_replies(after_id: Optional[ObjectId] = None,
+                                       batch_size: int = 1000) -> Iterator[dict]:
+    query = {'replies.0': {'$exists': True}}
+
+    if after_id:
+        query['_id'] = {'$gt': after_id}
+
+    return (
+        db.tiktoks.find(query, {'message_id': 1, 'sent_by_id': 1, 'sent_at': 1, 'replies': 1}, batch_size=batch_size)
+        .sort('_id', ASCENDING)
+    )
+
+
+def copy_embedded_replies(tiktoks: list[dict], drop_embedded: bool = False) -> int:
+    operations = [
+        UpdateOne(
+            {'tiktok_message_id': tiktok['message_id'], 'sent_by_id': reply['sent_by_id']},
+            {'$setOnInsert': form_db_stored_reply(tiktok, reply)},
+            upsert=True
+        )
+        for tiktok in tiktoks
+        for reply in tiktok['replies']
+    ]
+
+    if not operations:
+        return 0
+
+    result = db.replies.bulk_write(operations, ordered=False)
+
+    if drop_embedded:
+        db.tiktoks.bulk_write([
+            UpdateOne(
+                {'_id': tiktok['_id'], 'replies': {'$size': len(tiktok['replies'])}},
+                {'$unset': {'replies': ''}}
+            )
+            for tiktok in tiktoks
+        ], ordered=False)
+
+    return result.upserted_count
+
+
+def iter_tiktoks_sent_between(start: Optional[datetime], end: datetime, batch_size: int = 1000) -> Iterator[dict]:
+    sent_at = {'$lt': end}
+
+    if start:
+        sent_at['$gte'] = start
+
+    return _iter_tiktoks(
+        {'sent_at': sent_at},
+        {
+            '_id': 0, 'message_id': 1, 'sent_by_id': 1, 'sent_at': 1, 'video_id': 1, 'share_key': 1,
+            'replies.message_id': 1, 'replies.sent_by_id': 1, 'replies.sent_at': 1,
+            'replies.text': 1, 'replies.laugh_indicator': 1
+        },
+        batch_size=batch_size,
+        sort='sent_at'
+    )
+
+
+DERIVED_REBUILDS = {
+    'users counters': rebuild_sent_tiktoks_counters,
+    'not_answered_tiktoks': rebuild_not_answered_tiktoks,
+    'daily_stats': rebuild_daily_stats,
+    'reactions': rebuild_reactions,
+    'interactions': rebuild_interactions,
+}
+
+
+def bootstrap_derived_collections() -> list[str]:
+    # Derived collections are only kept up to date by the writes, so a database
+    # from before one existed has to be rebuilt once, which the marker records
+    marker = db.migrations.find_one({'_id': 'derived_collections'}) or {}
+    missing = [name for name in DERIVED_REBUILDS if name not in marker.get('built', [])]
+
+    if not missing:
+        return []
+
+    rebuilt = []
+
+    if db.tiktoks.find_one({}, {'_id': 1}):
+        for name in missing:
+            DERIVED_REBUILDS[name]()
+            rebuilt.append(name)
+
+        query_cache.invalidate()
+
+    db.migrations.update_one(
+        {'_id': 'derived_collections'},
+        {'$addToSet': {'built': {'$each': missing}}, '$set': {'updated_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+    return rebuilt
+
+
+def load_known_video_ids() -> None:
+    known_video_ids.load(
+        d['video_id'] for d in db.tiktoks.find({'video_id': {'$ne': None}}, {'_id': 0, 'video_id': 1})
+    )
+
+
+def start_known_video_ids_reload(interval_seconds: float) -> None:
+    # history_export and maintenance set video ids from other processes
+    def reload_forever() -> None:
+        while True:
+            time.sleep(interval_seconds)
+
+            try:
+                load_known_video_ids()
+            except Exception:
+                traceback.print_exc()
+
+    threading.Thread(target=reload_forever, name='video-id-index-reload', daemon=True).start()
+
+
+@query_cache.cached
+def get_tiktoks_with_same_video_id(user_id: int, video_id: str, share_key: Optional[str] = None) -> list:
+    # An earlier post that was never resolved can only be found by its share key
+    matches = [{'video_id': video_id}] if known_video_ids.might_contain(video_id) else []
+
+    if share_key:
+        matches.append({'share_key': share_key})
+
+    if not matches:
+        return []
+
+    return _get_tiktoks_matching(matches[0] if len(matches) == 1 else {'$or': matches})
+
+
+@query_cache.cached
+def get_tiktoks_with_same_share_key(user_id: int, share_key: str) -> list:
+    return _get_tiktoks_matching({'share_key': share_key})
+
+
+def get_unresolved_tiktoks(limit: int, after_id: Optional[ObjectId] = None) -> list:
+    query = {'video_id': None}
+
+    if after_id:
+        query['_id'] = {'$gt': after_id}
+
+    return list(
+        db.tiktoks.find(query, {'message_id': 1, 'text': 1})
+        .sort('_id', ASCENDING)
+        .limit(limit)
+    )
+
+
+def _get_tiktoks_matching(match: dict) -> list:
+    query = [
+        {
+            '$match': match
+        },
         {
             '$lookup': {
                 'from': 'users',
@@ -337,6 +1186,68 @@ def get_tiktoks_with_same_video_id(user_id: int, video_id: str) -> int:
     return list(db.tiktoks.aggregate(query))
 
 
+def _replies_lookup_stages() -> list[dict]:
+    if not READ_REPLIES_COLLECTION:
+        return []
+
+    return [{
+        '$lookup': {
+            'from': 'replies',
+            'localField': 'message_id',
+            'foreignField': 'tiktok_message_id',
+            'as': 'replies'
+        }
+    }]
+
+
+def _iter_tiktoks(query: dict, projection: dict, batch_size: int = 1000,
+                  only_replied: bool = False, sort: str = '_id') -> Iterator[dict]:
+    if not READ_REPLIES_COLLECTION:
+        if only_replied:
+            query = query | {'replies.0': {'$exists': True}}
+
+        yield from db.tiktoks.find(query, projection, batch_size=batch_size).sort(sort, ASCENDING)
+        return
+
+    tiktok_projection = {f: v for f, v in projection.items() if not f.startswith('replies.')}
+    reply_projection = {f.removeprefix('replies.'): v for f, v in projection.items() if f.startswith('replies.')}
+    tiktoks = (
+        db.tiktoks.find(query, tiktok_projection | {'message_id': 1}, batch_size=batch_size)
+        .sort(sort, ASCENDING)
+    )
+
+    while batch := list(itertools.islice(tiktoks, batch_size)):
+        replies = defaultdict(list)
+        stored_replies = db.replies.find(
+            {'tiktok_message_id': {'$in': [t['message_id'] for t in batch]}},
+            reply_projection | {'tiktok_message_id': 1}
+        ).sort('_id', ASCENDING)
+
+        for reply in stored_replies:
+            replies[reply.pop('tiktok_message_id')].append(reply)
+
+        for tiktok in batch:
+            tiktok['replies'] = replies[tiktok['message_id']]
+
+            if tiktok['replies'] or not only_replied:
+                yield tiktok
+
+
+def _get_reply_time(tiktok: dict, reply: dict) -> float:
+    return (_to_naive_utc(reply['sent_at']) - _to_naive_utc(tiktok['sent_at'])) / timedelta(milliseconds=1)
+
+
+def _to_naive_utc(moment: datetime) -> datetime:
+    if moment.tzinfo:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return moment
+
+
+def _get_day_beginning(moment: datetime) -> datetime:
+    return _to_naive_utc(moment).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
 def _add_date_filter_if_provided(query: list[dict], start_date: Optional[datetime]) -> dict:
     if start_date:
         query.insert(0, {'$match': {'sent_at': {'$gt': start_date}}})
@@ -0,0 +1,53 @@
+import argparse
+import json
+import time
+import urllib.request
+
+
+def form_fake_update(args: argparse.Namespace) -> dict:
+    now = int(time.time())
+    chat = {'id': args.chat_id, 'type': 'supergroup', 'title': '#temptok'}
+    message = {
+        'message_id': args.message_id or now,
+        'date': now,
+        'chat': chat,
+        'from': {'id': args.user_id, 'is_bot': False, 'first_name': args.first_name},
+        'text': args.text
+    }
+
+    if args.text.startswith('/'):
+        command = args.text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+
+    if args.reply_to:
+        message['reply_to_message'] = {
+            'message_id': args.reply_to,
+            'date': now,
+            'chat': chat,
+            'text': ''
+        }
+
+    return {'update_id': now, 'message': message}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post a fake Telegram update to a locally running webhook')
+    parser.add_argument('text', help='message text, e.g. "https://vm.tiktok.com/abc/" or "/stats"')
+    parser.add_argument('--url', default='http://localhost:8443/telegram',
+                        help='local webhook url, the default matches a bot started with WEBHOOK_SECRET_PATH=telegram')
+    parser.add_argument('--chat-id', type=int, required=True)
+    parser.add_argument('--user-id', type=int, required=True)
+    parser.add_argument('--first-name', default='Test')
+    parser.add_argument('--message-id', type=int)
+    parser.add_argument('--reply-to', type=int, help='message id the fake message replies to')
+    args = parser.parse_args()
+
+    request = urllib.request.Request(
+        args.url,
+        data=json.dumps(form_fake_update(args)).encode(),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+
+    with urllib.request.urlopen(request) as response:
+        print(f'Webhook answered {response.status}')
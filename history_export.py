@@ -1,79 +1,238 @@
+import argparse
+import asyncio
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-from telethon.sync import TelegramClient
+from telethon import TelegramClient
+from telethon.tl.custom import Message
 from telethon.tl.functions.channels import GetFullChannelRequest
 from telethon.tl.types import Channel
 
-from db import db, save_sent_tiktok, save_tiktok_reply_if_applicable
-from tiktok import EXTRACT_SHARE_URL_FROM_TIKTOK, get_tiktok_id_by_share_url
+from bulk_ingest import BulkIngestor
+from db import (db, ensure_indexes, get_export_checkpoint, rebuild_daily_stats,
+                rebuild_interactions, rebuild_not_answered_tiktoks,
+                rebuild_reactions, rebuild_sent_tiktoks_counters,
+                save_export_checkpoint, save_sent_tiktok,
+                save_tiktok_reply_if_applicable)
+from resolver import get_resolver_stats, resolve_video_id
+from tiktok import EXTRACT_SHARE_URL_FROM_TIKTOK, set_session_pool_size
 
 BOT_CHAT_ID = 1535478327
 
+PROGRESS_INTERVAL_SECONDS = 10
 
-def export_tiktoks(client: TelegramClient, channel: Channel) -> None:
-    count_tiktoks = 0
 
-    print('Started exporting tiktok-related messages')
+class ExportProgress:
+    def __init__(self) -> None:
+        self.started_at = time.monotonic()
+        self.printed_at = self.started_at
+        self.messages_count = 0
+        self.tiktoks_count = 0
 
-    for message in client.iter_messages(channel, None, reverse=True):
-        if not message.text:
-            continue
+    def track(self, is_tiktok: bool) -> None:
+        self.messages_count += 1
+        self.tiktoks_count += is_tiktok
 
-        user_id = message.sender.id
+        now = time.monotonic()
 
-        if m := re.match(EXTRACT_SHARE_URL_FROM_TIKTOK, message.text):
-            count_tiktoks += 1
+        if now - self.printed_at >= PROGRESS_INTERVAL_SECONDS:
+            self.printed_at = now
+            self.print()
 
-            video_id = get_tiktok_id_by_share_url(m.group(1))
-            save_sent_tiktok(user_id, message.id, message.date, message.text, video_id)
+    def print(self) -> None:
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        print(
+            f'Exported {self.tiktoks_count} tiktoks from {self.messages_count} messages '
+            f'({self.messages_count / elapsed:.0f} messages/s, {self.tiktoks_count / elapsed:.1f} tiktoks/s)'
+        )
 
-            if count_tiktoks % 100 == 0:
-                print(f'Exported another {count_tiktoks} from group')
 
-        if message.reply_to_msg_id:
-            replied_user = db.users.find_one({'user_id': user_id})
+async def export_tiktoks(client: TelegramClient, channel: Channel, users: dict,
+                         ingestor: Optional[BulkIngestor], args: argparse.Namespace,
+                         migrated_from_chat_id: Optional[int] = None) -> None:
+    min_message_id = 0
+
+    if args.incremental and (checkpoint := get_export_checkpoint(channel.id)):
+        min_message_id = checkpoint['last_message_id']
+
+    print(f'Started exporting tiktok-related messages after message {min_message_id}')
+
+    loop = asyncio.get_running_loop()
+    set_session_pool_size(args.resolve_concurrency)
+    resolve_executor = ThreadPoolExecutor(max_workers=args.resolve_concurrency, thread_name_prefix='export-resolver')
+    write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export-writer')
+    semaphore = asyncio.Semaphore(args.resolve_concurrency)
+    queue = asyncio.Queue(maxsize=args.queue_size)
+
+    async def resolve(share_url: str) -> Optional[str]:
+        async with semaphore:
+            try:
+                return await loop.run_in_executor(resolve_executor, resolve_video_id, share_url)
+            except Exception as e:
+                print(f'Cannot get video_id of tiktok {share_url}: {repr(e)}')
+                return None
+
+    async def fetch() -> None:
+        async for message in client.iter_messages(channel, None, reverse=True, min_id=min_message_id):
+            if not message.text:
+                continue
+
+            video_id_task = None
 
-            if replied_user:
-                save_tiktok_reply_if_applicable(
-                    replied_user, message.reply_to_msg_id,
-                    message.id, message.date, message.text
-                )
+            if m := re.match(EXTRACT_SHARE_URL_FROM_TIKTOK, message.text):
+                video_id_task = asyncio.create_task(resolve(m.group(1)))
 
+            await queue.put((message, video_id_task))
 
-with TelegramClient('tg_session', os.environ['TG_API_ID'], os.environ['TG_API_HASH']) as client:
-    dialogs = client.get_dialogs()
-    temptok_dialog = next(d for d in dialogs if d.name == '#temptok')
+        await queue.put(None)
 
-    participants = client.get_participants(temptok_dialog.entity)
+    def checkpoint(last_message_id: int) -> None:
+        if ingestor:
+            ingestor.flush()
 
-    for participant in participants:
+        save_export_checkpoint(channel.id, last_message_id, migrated_from_chat_id)
 
-        if participant.id == BOT_CHAT_ID:
-            continue
+    async def write() -> None:
+        progress = ExportProgress()
+        last_message_id = None
 
-        db_user = db.users.find_one({'user_id': participant.id})
+        while item := await queue.get():
+            message, video_id_task = item
+            video_id = await video_id_task if video_id_task else None
 
-        if not db_user:
-            db.users.insert_one(
-                {
-                    'user_id': participant.id,
-                    'name': participant.first_name,
-                    'gen': 'm',
-                    'last_replied_tiktok_id': None,
-                    'last_replied_at': None,
-                    'tiktoks_replied_count': 0
-                }
+            await loop.run_in_executor(
+                write_executor, write_message,
+                message, video_id_task is not None, video_id, users, ingestor
             )
+            progress.track(video_id_task is not None)
+            last_message_id = message.id
 
-    db.tiktoks.delete_many({})
+            if progress.messages_count % args.checkpoint_every == 0:
+                await loop.run_in_executor(write_executor, checkpoint, last_message_id)
 
-    full_channel = client(GetFullChannelRequest(temptok_dialog.entity)).full_chat
+        if last_message_id:
+            await loop.run_in_executor(write_executor, checkpoint, last_message_id)
 
-    if full_channel.migrated_from_chat_id:
-        print('Found old style group. First exporting from it')
-        export_tiktoks(client, client.get_entity(full_channel.migrated_from_chat_id))
+        progress.print()
 
-    export_tiktoks(client, temptok_dialog.entity)
+    try:
+        await asyncio.gather(fetch(), write())
+    finally:
+        resolve_executor.shutdown(wait=False)
+        write_executor.shutdown()
+
+
+def write_message(message: Message, is_tiktok: bool, video_id: Optional[str],
+                  users: dict, ingestor: Optional[BulkIngestor]) -> None:
+    user_id = message.sender_id
+
+    if ingestor:
+        if is_tiktok:
+            ingestor.save_sent_tiktok(user_id, message.id, message.date, message.text, video_id)
+
+        if message.reply_to_msg_id:
+            ingestor.save_tiktok_reply_if_applicable(
+                user_id, message.reply_to_msg_id,
+                message.id, message.date, message.text
+            )
 
-    print('Done')
+        return
+
+    if is_tiktok:
+        save_sent_tiktok(user_id, message.id, message.date, message.text, video_id)
+
+    if message.reply_to_msg_id and (replied_user := users.get(user_id)):
+        save_tiktok_reply_if_applicable(
+            replied_user, message.reply_to_msg_id,
+            message.id, message.date, message.text
+        )
+
+
+def save_new_participants(participants: list) -> dict:
+    users = {u['user_id']: u for u in db.users.find({})}
+    new_users = [
+        {
+            'user_id': participant.id,
+            'name': participant.first_name,
+            'gen': 'm',
+            'last_replied_tiktok_id': None,
+            'last_replied_at': None,
+            'tiktoks_replied_count': 0
+        }
+        for participant in participants
+        if participant.id != BOT_CHAT_ID and participant.id not in users
+    ]
+
+    if new_users:
+        db.users.insert_many(new_users)
+
+    return users | {u['user_id']: u for u in new_users}
+
+
+async def main(args: argparse.Namespace) -> None:
+    ensure_indexes()
+
+    async with TelegramClient('tg_session', os.environ['TG_API_ID'], os.environ['TG_API_HASH']) as client:
+        dialogs = await client.get_dialogs()
+        temptok_dialog = next(d for d in dialogs if d.name == '#temptok')
+
+        participants = await client.get_participants(temptok_dialog.entity)
+        users = save_new_participants(participants)
+        ingestor = BulkIngestor(users, batch_size=args.batch_size) if args.bulk else None
+
+        if args.incremental:
+            if ingestor:
+                ingestor.preload_tiktoks()
+        else:
+            db.tiktoks.delete_many({})
+            db.replies.delete_many({})
+            db.export_checkpoints.delete_many({})
+
+        checkpoint = get_export_checkpoint(temptok_dialog.entity.id) if args.incremental else None
+
+        if checkpoint:
+            migrated_from_chat_id = checkpoint['migrated_from_chat_id']
+        else:
+            full_channel = (await client(GetFullChannelRequest(temptok_dialog.entity))).full_chat
+            migrated_from_chat_id = full_channel.migrated_from_chat_id
+
+        if migrated_from_chat_id:
+            print('Found old style group. First exporting from it')
+            migrated_from_chat = await client.get_entity(migrated_from_chat_id)
+            await export_tiktoks(client, migrated_from_chat, users, ingestor, args)
+
+        await export_tiktoks(client, temptok_dialog.entity, users, ingestor, args, migrated_from_chat_id)
+
+        print('Rebuilding derived counters')
+        rebuild_sent_tiktoks_counters()
+        rebuild_not_answered_tiktoks()
+        rebuild_daily_stats()
+        rebuild_reactions()
+        rebuild_interactions()
+
+        if ingestor:
+            print(f'Bulk ingestion took {ingestor.round_trips} write round trips')
+
+        print(f'Resolver cache stats: {get_resolver_stats()}')
+        print('Done')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export tiktoks and replies from #temptok history')
+    parser.add_argument('--resolve-concurrency', type=int, default=16,
+                        help='how many share URLs are resolved at the same time')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='how many fetched messages may wait for resolution and writing')
+    parser.add_argument('--bulk', action='store_true',
+                        help='buffer writes and flush them with unordered bulk_write')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='how many operations are sent in one bulk_write')
+    parser.add_argument('--incremental', action='store_true',
+                        help='resume from the stored checkpoints instead of re-importing everything')
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help='how many messages are written between two checkpoints')
+
+    asyncio.run(main(parser.parse_args()))
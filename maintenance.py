@@ -0,0 +1,310 @@
+import argparse
+import math
+import sys
+from datetime import datetime, timedelta
+from typing import Callable
+
+from pymongo import monitoring
+
+from db import (REPLIES_STORAGE, compute_stats_summary, copy_embedded_replies,
+                db, delete_backfill_checkpoint, ensure_indexes,
+                get_backfill_checkpoint, get_not_answered_tiktoks_summary,
+                get_personal_income_stats, get_personal_outcome_stats,
+                get_reply_fields_changes, get_sent_tiktoks_stats,
+                get_stats_summary, get_tiktoks_with_same_share_key,
+                get_tiktoks_with_same_video_id, get_today_sent_tiktoks_count,
+                get_top_most_popular_reactions, get_unresolved_tiktoks,
+                iter_tiktoks_with_embedded_replies, iter_tiktoks_with_replies,
+                rebuild_daily_stats, rebuild_interactions,
+                rebuild_not_answered_tiktoks, rebuild_reactions,
+                rebuild_sent_tiktoks_counters, save_backfill_checkpoint,
+                save_reply_fields_changes)
+from resolver import backfill_unresolved_video_ids, get_resolver_stats
+
+EXPLAINED_COMMANDS = ('find', 'aggregate', 'count', 'distinct')
+BACKFILL_REPLIES_CHECKPOINT = 'backfill_replies'
+MIGRATE_REPLIES_CHECKPOINT = 'migrate_replies'
+
+
+class CommandRecorder(monitoring.CommandListener):
+    def __init__(self) -> None:
+        self.commands = []
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name in EXPLAINED_COMMANDS:
+            self.commands.append({
+                k: v for k, v in event.command.items()
+                if not k.startswith('$') and k != 'lsid'
+            })
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+
+def get_query_checks() -> dict[str, Callable]:
+    sample_user = db.users.find_one({}) or {'user_id': 0}
+    sample_tiktok = db.tiktoks.find_one({'video_id': {'$ne': None}}) or {'video_id': '', 'share_key': ''}
+    user_id = sample_user['user_id']
+    start_date = datetime.utcnow() - timedelta(days=30)
+
+    return {
+        'get_not_answered_tiktoks_summary': lambda: get_not_answered_tiktoks_summary(user_id, timedelta(hours=1)),
+        'get_sent_tiktoks_stats': lambda: get_sent_tiktoks_stats(start_date),
+        'get_stats_summary': lambda: get_stats_summary(start_date),
+        'get_top_most_popular_reactions': lambda: get_top_most_popular_reactions(user_id),
+        'get_top_most_popular_reactions(date)': lambda: get_top_most_popular_reactions(user_id, start_date),
+        'get_personal_income_stats': lambda: get_personal_income_stats(user_id, start_date),
+        'get_personal_outcome_stats': lambda: get_personal_outcome_stats(user_id, start_date),
+        'get_today_sent_tiktoks_count': lambda: get_today_sent_tiktoks_count(user_id),
+        'get_tiktoks_with_same_video_id': lambda: get_tiktoks_with_same_video_id(
+            user_id, sample_tiktok['video_id']
+        ),
+        'get_tiktoks_with_same_share_key': lambda: get_tiktoks_with_same_share_key(
+            user_id, sample_tiktok.get('share_key') or ''
+        ),
+        'get_unresolved_tiktoks': lambda: get_unresolved_tiktoks(100),
+    }
+
+
+def has_collscan(node: object, in_winning_plan: bool = False) -> bool:
+    if isinstance(node, dict):
+        if in_winning_plan and node.get('stage') == 'COLLSCAN':
+            return True
+
+        return any(
+            has_collscan(v, in_winning_plan or k == 'winningPlan')
+            for k, v in node.items() if k != 'rejectedPlans'
+        )
+
+    if isinstance(node, list):
+        return any(has_collscan(v, in_winning_plan) for v in node)
+
+    return False
+
+
+def check_query_plans(args: argparse.Namespace) -> int:
+    recorder = CommandRecorder()
+    db.connect(event_listeners=[recorder])
+
+    failed = False
+
+    for name, check in get_query_checks().items():
+        recorder.commands = []
+        check()
+
+        for command in recorder.commands:
+            explain = db.command({'explain': command, 'verbosity': 'queryPlanner'})
+            collscan = has_collscan(explain)
+            failed |= collscan
+
+            status = 'COLLSCAN' if collscan else 'ok'
+            print(f'{status:<8} {name} ({next(iter(command))})')
+
+    return 1 if failed else 0
+
+
+def run_ensure_indexes(args: argparse.Namespace) -> int:
+    ensure_indexes()
+    print('Indexes are in place')
+
+    return 0
+
+
+def run_rebuild_counters(args: argparse.Namespace) -> int:
+    rebuild_sent_tiktoks_counters()
+    print('Sent tiktoks counters are rebuilt')
+
+    return 0
+
+
+def run_rebuild_not_answered(args: argparse.Namespace) -> int:
+    rebuild_not_answered_tiktoks()
+    print('Not answered tiktoks are rebuilt')
+
+    return 0
+
+
+def run_rebuild_daily_stats(args: argparse.Namespace) -> int:
+    rebuild_daily_stats()
+    print('Daily stats are rebuilt')
+
+    return 0
+
+
+def run_rebuild_reactions(args: argparse.Namespace) -> int:
+    rebuild_reactions()
+    print('Reactions are rebuilt')
+
+    return 0
+
+
+def run_rebuild_interactions(args: argparse.Namespace) -> int:
+    rebuild_interactions()
+    print('Interactions are rebuilt')
+
+    return 0
+
+
+def run_verify_daily_stats(args: argparse.Namespace) -> int:
+    expected = compute_stats_summary()
+    actual = get_stats_summary()
+    mismatches = 0
+
+    for facet, expected_stats in expected.items():
+        for user_id in expected_stats.keys() | actual[facet].keys():
+            expected_user_stats = expected_stats.get(user_id, {})
+            actual_user_stats = actual[facet].get(user_id, {})
+
+            for field in expected_user_stats.keys() | actual_user_stats.keys():
+                expected_value = expected_user_stats.get(field)
+                actual_value = actual_user_stats.get(field)
+
+                if expected_value == actual_value or (
+                    isinstance(expected_value, (int, float)) and isinstance(actual_value, (int, float))
+                    and math.isclose(expected_value, actual_value, rel_tol=1e-9)
+                ):
+                    continue
+
+                mismatches += 1
+                print(f'{facet} {user_id} {field}: expected {expected_value}, got {actual_value}')
+
+    print(f'Daily stats verified with {mismatches} mismatches')
+
+    return 1 if mismatches else 0
+
+
+def run_backfill_video_ids(args: argparse.Namespace) -> int:
+    resolved_count = backfill_unresolved_video_ids(args.batch_size)
+    print(f'Resolved video_id of {resolved_count} tiktoks')
+    print(f'Resolver cache stats: {get_resolver_stats()}')
+
+    return 0
+
+
+def run_backfill_replies(args: argparse.Namespace) -> int:
+    after_id = None
+
+    if args.resume and (checkpoint := get_backfill_checkpoint(BACKFILL_REPLIES_CHECKPOINT)):
+        after_id = checkpoint['last_id']
+        print(f'Resuming after tiktok {after_id}')
+
+    scanned_count = changed_count = modified_count = 0
+    batch = []
+
+    for tiktok in iter_tiktoks_with_replies(after_id, args.batch_size):
+        scanned_count += 1
+
+        if changes := get_reply_fields_changes(tiktok):
+            changed_count += 1
+
+            if args.dry_run:
+                for field, (old, new) in changes.items():
+                    print(f"{tiktok['message_id']} {field}: {old} -> {new}")
+            else:
+                batch.append((tiktok, changes))
+
+        if scanned_count % args.batch_size == 0 and not args.dry_run:
+            modified_count += save_reply_fields_changes(batch)
+            save_backfill_checkpoint(BACKFILL_REPLIES_CHECKPOINT, tiktok['_id'])
+            batch = []
+
+    if args.dry_run:
+        print(f'Scanned {scanned_count} tiktoks, {changed_count} would change')
+        return 0
+
+    modified_count += save_reply_fields_changes(batch)
+    delete_backfill_checkpoint(BACKFILL_REPLIES_CHECKPOINT)
+
+    # A resumed run may follow an interrupted one that already changed replies
+    if modified_count or after_id:
+        rebuild_daily_stats()
+        rebuild_interactions()
+
+    print(f'Scanned {scanned_count} tiktoks, updated {modified_count} of {changed_count} changed')
+
+    return 0
+
+
+def run_migrate_replies(args: argparse.Namespace) -> int:
+    if args.drop_embedded and REPLIES_STORAGE != 'collection':
+        print('Embedded replies can be dropped only with REPLIES_STORAGE=collection')
+        return 1
+
+    after_id = None
+
+    if args.resume and (checkpoint := get_backfill_checkpoint(MIGRATE_REPLIES_CHECKPOINT)):
+        after_id = checkpoint['last_id']
+        print(f'Resuming after tiktok {after_id}')
+
+    copied_count = 0
+    batch = []
+
+    for tiktok in iter_tiktoks_with_embedded_replies(after_id, args.batch_size):
+        batch.append(tiktok)
+
+        if len(batch) == args.batch_size:
+            copied_count += copy_embedded_replies(batch, args.drop_embedded)
+            save_backfill_checkpoint(MIGRATE_REPLIES_CHECKPOINT, tiktok['_id'])
+            batch = []
+
+    copied_count += copy_embedded_replies(batch, args.drop_embedded)
+    delete_backfill_checkpoint(MIGRATE_REPLIES_CHECKPOINT)
+
+    print(f'Copied {copied_count} replies into the replies collection')
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Database maintenance for the temptok bot')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser('ensure-indexes', help='create the indexes declared in db.INDEXES')
+    subparser.set_defaults(func=run_ensure_indexes)
+
+    subparser = subparsers.add_parser('check-query-plans', help='fail if any db.py query falls back to a COLLSCAN')
+    subparser.set_defaults(func=check_query_plans)
+
+    subparser = subparsers.add_parser('rebuild-counters', help='rebuild per-user sent tiktoks counters')
+    subparser.set_defaults(func=run_rebuild_counters)
+
+    subparser = subparsers.add_parser('rebuild-not-answered', help='rebuild the per-user not answered tiktoks')
+    subparser.set_defaults(func=run_rebuild_not_answered)
+
+    subparser = subparsers.add_parser('rebuild-daily-stats', help='rebuild the per-user daily stats buckets')
+    subparser.set_defaults(func=run_rebuild_daily_stats)
+
+    subparser = subparsers.add_parser('rebuild-reactions', help='rebuild the per-user reaction frequencies')
+    subparser.set_defaults(func=run_rebuild_reactions)
+
+    subparser = subparsers.add_parser('rebuild-interactions', help='rebuild who replies to whom per day')
+    subparser.set_defaults(func=run_rebuild_interactions)
+
+    subparser = subparsers.add_parser('verify-daily-stats', help='compare daily stats buckets with the tiktoks')
+    subparser.set_defaults(func=run_verify_daily_stats)
+
+    subparser = subparsers.add_parser('backfill-video-ids', help='resolve video_id of tiktoks stored without it')
+    subparser.add_argument('--batch-size', type=int, default=100)
+    subparser.set_defaults(func=run_backfill_video_ids)
+
+    subparser = subparsers.add_parser('backfill-replies', help='recompute derived reply fields like laugh_indicator')
+    subparser.add_argument('--batch-size', type=int, default=1000)
+    subparser.add_argument('--resume', action='store_true', help='continue after the last saved checkpoint')
+    subparser.add_argument('--dry-run', action='store_true', help='print the changes instead of writing them')
+    subparser.set_defaults(func=run_backfill_replies)
+
+    subparser = subparsers.add_parser(
+        'migrate-replies',
+        help='copy embedded replies into the replies collection, run while the bot uses REPLIES_STORAGE=dual'
+    )
+    subparser.add_argument('--batch-size', type=int, default=1000)
+    subparser.add_argument('--resume', action='store_true', help='continue after the last saved checkpoint')
+    subparser.add_argument('--drop-embedded', action='store_true',
+                           help='unset the copied arrays, requires REPLIES_STORAGE=collection')
+    subparser.set_defaults(func=run_migrate_replies)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
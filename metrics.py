@@ -0,0 +1,104 @@
+import functools
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from pymongo import monitoring
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+METRICS_JSON_LOG = os.environ.get('METRICS_JSON_LOG', '') == '1'
+
+handler_duration = Histogram(
+    'bot_handler_duration_seconds', 'Time spent in a telegram handler', ['handler']
+)
+handler_errors = Counter(
+    'bot_handler_errors_total', 'Handlers that raised', ['handler']
+)
+mongo_command_duration = Histogram(
+    'mongo_command_duration_seconds', 'Duration of mongo commands', ['command', 'collection'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+mongo_command_failures = Counter(
+    'mongo_command_failures_total', 'Failed mongo commands', ['command', 'collection']
+)
+resolver_request_duration = Histogram(
+    'resolver_request_duration_seconds', 'Duration of tiktok share url requests'
+)
+resolver_lookups = Counter(
+    'resolver_lookups_total', 'Video id lookups by outcome', ['outcome']
+)
+dispatcher_queue_depth = Gauge(
+    'bot_dispatcher_queue_depth', 'Updates waiting in the dispatcher queue or in handlers'
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self) -> None:
+        self._collections = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection = self._collections.pop(event.request_id, '')
+        mongo_command_duration.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        log_event('mongo_command', command=event.command_name, collection=collection,
+                  duration_ms=event.duration_micros / 1000)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection = self._collections.pop(event.request_id, '')
+        mongo_command_failures.labels(event.command_name, collection).inc()
+        log_event('mongo_command', command=event.command_name, collection=collection,
+                  duration_ms=event.duration_micros / 1000, failure=str(event.failure))
+
+
+_mongo_listener_lock = threading.Lock()
+_mongo_listener: Optional[MongoCommandMetrics] = None
+
+
+def register_mongo_listener() -> None:
+    # Only clients created after the registration report their commands
+    global _mongo_listener
+
+    with _mongo_listener_lock:
+        if _mongo_listener is None:
+            _mongo_listener = MongoCommandMetrics()
+            monitoring.register(_mongo_listener)
+
+
+def start_metrics_server() -> None:
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT, addr='127.0.0.1')
+
+
+def timed_handler(name: str) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper_func(*args, **kwargs):
+            started_at = time.perf_counter()
+            error = None
+
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = e
+                handler_errors.labels(name).inc()
+                raise
+            finally:
+                duration = time.perf_counter() - started_at
+                handler_duration.labels(name).observe(duration)
+                log_event('handler', handler=name, duration_ms=duration * 1000,
+                          error=repr(error) if error else None)
+
+        return wrapper_func
+
+    return decorator
+
+
+def log_event(event: str, **fields) -> None:
+    if METRICS_JSON_LOG:
+        print(json.dumps({'event': event, 'at': time.time()} | fields, ensure_ascii=False), flush=True)
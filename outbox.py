@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+import traceback
+from collections import defaultdict, deque
+from typing import Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+CHAT_INTERVAL_SECONDS = float(os.environ.get('OUTBOX_CHAT_INTERVAL_SECONDS', 1))
+GLOBAL_MESSAGES_PER_SECOND = int(os.environ.get('OUTBOX_GLOBAL_MESSAGES_PER_SECOND', 25))
+MAX_ATTEMPTS = 3
+MAX_MESSAGE_LENGTH = 4096
+
+
+class Outbox:
+    def __init__(self, bot: Bot, chat_interval: float = CHAT_INTERVAL_SECONDS,
+                 global_per_second: int = GLOBAL_MESSAGES_PER_SECOND) -> None:
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.global_per_second = global_per_second
+
+        self._chat_queues = defaultdict(deque)
+        self._chat_ready_at = defaultdict(float)
+        self._sent_at = deque()
+        self._condition = threading.Condition()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name='outbox', daemon=True).start()
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> None:
+        self._put(chat_id, 'send_message', {'chat_id': chat_id, 'text': text} | kwargs)
+
+    def forward_message(self, chat_id: int, from_chat_id: int, message_id: int) -> None:
+        self._put(chat_id, 'forward_message', {
+            'chat_id': chat_id, 'from_chat_id': from_chat_id, 'message_id': message_id
+        })
+
+    def _put(self, chat_id: int, method: str, kwargs: dict) -> None:
+        with self._condition:
+            self._chat_queues[chat_id].append({'method': method, 'kwargs': kwargs, 'attempts': 0})
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                chat_id, wait = self._get_ready_chat()
+
+                if chat_id is None:
+                    self._condition.wait(timeout=wait)
+                    continue
+
+                message = self._take_coalesced(chat_id)
+                now = time.monotonic()
+                self._chat_ready_at[chat_id] = now + self.chat_interval
+                self._sent_at.append(now)
+
+            self._deliver(chat_id, message)
+
+    def _get_ready_chat(self) -> tuple[Optional[int], Optional[float]]:
+        now = time.monotonic()
+
+        while self._sent_at and self._sent_at[0] <= now - 1:
+            self._sent_at.popleft()
+
+        if len(self._sent_at) >= self.global_per_second:
+            return None, self._sent_at[0] + 1 - now
+
+        waiting_chats = [chat_id for chat_id, messages in self._chat_queues.items() if messages]
+
+        if not waiting_chats:
+            return None, None
+
+        chat_id = min(waiting_chats, key=lambda c: self._chat_ready_at[c])
+        ready_at = self._chat_ready_at[chat_id]
+
+        if ready_at > now:
+            return None, ready_at - now
+
+        return chat_id, None
+
+    def _take_coalesced(self, chat_id: int) -> dict:
+        messages = self._chat_queues[chat_id]
+        message = messages.popleft()
+
+        if not _is_plain_message(message):
+            return message
+
+        texts = [message['kwargs']['text']]
+        length = len(texts[0])
+
+        while (
+            messages and _is_plain_message(messages[0])
+            and length + len(messages[0]['kwargs']['text']) + 2 <= MAX_MESSAGE_LENGTH
+        ):
+            text = messages.popleft()['kwargs']['text']
+            texts.append(text)
+            length += len(text) + 2
+
+        return message | {'kwargs': message['kwargs'] | {'text': '\n\n'.join(texts)}}
+
+    def _deliver(self, chat_id: int, message: dict) -> None:
+        message['attempts'] += 1
+
+        try:
+            getattr(self.bot, message['method'])(**message['kwargs'])
+        except RetryAfter as e:
+            self._retry(chat_id, message, delay=e.retry_after)
+        except BadRequest:
+            traceback.print_exc()
+        except NetworkError:
+            if message['attempts'] < MAX_ATTEMPTS:
+                self._retry(chat_id, message, delay=self.chat_interval * message['attempts'])
+            else:
+                traceback.print_exc()
+        except Exception:
+            # Anything else would kill the sender thread and silently stop all delivery
+            traceback.print_exc()
+
+    def _retry(self, chat_id: int, message: dict, delay: float) -> None:
+        with self._condition:
+            self._chat_queues[chat_id].appendleft(message)
+            self._chat_ready_at[chat_id] = time.monotonic() + delay
+            self._condition.notify()
+
+
+def _is_plain_message(message: dict) -> bool:
+    return message['method'] == 'send_message' and message['kwargs'].keys() == {'chat_id', 'text'}
@@ -0,0 +1,40 @@
+import threading
+from typing import Any
+
+PLURAL_FORMS = {
+    'тикток': ('тикток', 'тиктока', 'тиктоков'),
+}
+
+_morph = None
+_morph_lock = threading.Lock()
+
+
+def make_agree_with_number(word: str, number: int) -> str:
+    if forms := PLURAL_FORMS.get(word):
+        return forms[_get_plural_form_index(number)]
+
+    return _get_morph().parse(word)[0].make_agree_with_number(number).word
+
+
+def _get_plural_form_index(number: int) -> int:
+    number = abs(number)
+
+    if number % 10 == 1 and number % 100 != 11:
+        return 0
+
+    if 2 <= number % 10 <= 4 and not 12 <= number % 100 <= 14:
+        return 1
+
+    return 2
+
+
+def _get_morph() -> Any:
+    global _morph
+
+    with _morph_lock:
+        if _morph is None:
+            # Dictionaries are large, so they are loaded only for words without a table
+            import pymorphy2
+            _morph = pymorphy2.MorphAnalyzer()
+
+    return _morph
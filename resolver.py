@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from cache import MISSING, LRUCache
+from db import (get_cached_video_id, get_unresolved_tiktoks,
+                save_cached_video_id, set_tiktok_video_id)
+from metrics import resolver_lookups, resolver_request_duration
+from tiktok import EXTRACT_SHARE_URL_FROM_TIKTOK, get_tiktok_id_by_share_url
+
+RESOLVED_TTL = timedelta(days=int(os.environ.get('RESOLVER_RESOLVED_TTL_DAYS', 90)))
+UNRESOLVED_TTL = timedelta(hours=int(os.environ.get('RESOLVER_UNRESOLVED_TTL_HOURS', 6)))
+
+RESOLVER_WORKERS = int(os.environ.get('RESOLVER_WORKERS', 4))
+
+memory_cache = LRUCache(maxsize=int(os.environ.get('RESOLVER_MEMORY_CACHE_SIZE', 10_000)))
+
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+executor = ThreadPoolExecutor(max_workers=RESOLVER_WORKERS, thread_name_prefix='resolver')
+
+
+def resolve_video_id(share_url: str) -> Optional[str]:
+    video_id = memory_cache.get(share_url)
+
+    if video_id is not MISSING:
+        _count('memory_hits' if video_id else 'negative_hits')
+        return video_id
+
+    if stored := get_cached_video_id(share_url):
+        _count('db_hits' if stored['video_id'] else 'negative_hits')
+        ttl = (stored['expires_at'] - datetime.utcnow()).total_seconds()
+        memory_cache.set(share_url, stored['video_id'], ttl=max(ttl, 0))
+        return stored['video_id']
+
+    _count('misses')
+
+    try:
+        with resolver_request_duration.time():
+            video_id = get_tiktok_id_by_share_url(share_url)
+    except Exception:
+        _count('errors')
+        _remember(share_url, None)
+        raise
+
+    _remember(share_url, video_id)
+
+    return video_id
+
+
+def submit_resolution(share_url: str,
+                      on_resolved: Callable[[Optional[str], Optional[Exception]], None]) -> Future:
+    return executor.submit(_resolve_and_notify, share_url, on_resolved)
+
+
+def backfill_unresolved_video_ids(batch_size: int = 100) -> int:
+    resolved_count = 0
+    last_id = None
+
+    while tiktoks := get_unresolved_tiktoks(batch_size, after_id=last_id):
+        last_id = tiktoks[-1]['_id']
+
+        for tiktok in tiktoks:
+            if not (m := re.search(EXTRACT_SHARE_URL_FROM_TIKTOK, tiktok['text'] or '')):
+                continue
+
+            try:
+                video_id = resolve_video_id(m.group(1))
+            except Exception:
+                continue
+
+            if video_id:
+                set_tiktok_video_id(tiktok['message_id'], video_id)
+                resolved_count += 1
+
+    return resolved_count
+
+
+def start_backfill(interval_seconds: float) -> None:
+    def run_backfill_forever() -> None:
+        while True:
+            time.sleep(interval_seconds)
+
+            try:
+                backfill_unresolved_video_ids()
+            except Exception:
+                traceback.print_exc()
+
+    threading.Thread(target=run_backfill_forever, name='video-id-backfill', daemon=True).start()
+
+
+def get_resolver_stats() -> dict:
+    with _counters_lock:
+        stats = dict(_counters)
+
+    stats['memory_cache_size'] = len(memory_cache)
+
+    return stats
+
+
+def _resolve_and_notify(share_url: str,
+                        on_resolved: Callable[[Optional[str], Optional[Exception]], None]) -> None:
+    video_id, error = None, None
+
+    try:
+        video_id = resolve_video_id(share_url)
+    except Exception as e:
+        error = e
+
+    try:
+        on_resolved(video_id, error)
+    except Exception:
+        traceback.print_exc()
+
+
+def _remember(share_url: str, video_id: Optional[str]) -> None:
+    ttl = RESOLVED_TTL if video_id else UNRESOLVED_TTL
+    memory_cache.set(share_url, video_id, ttl=ttl.total_seconds())
+    save_cached_video_id(share_url, video_id, ttl)
+
+
+def _count(counter: str) -> None:
+    resolver_lookups.labels(counter).inc()
+
+    with _counters_lock:
+        _counters[counter] += 1
@@ -4,7 +4,7 @@ from typing import Callable
 from telegram.ext import CallbackContext
 from telegram.update import Update
 
-from db import db
+from user_directory import user_directory
 
 
 def known_user(func: Callable) -> Callable:
@@ -12,7 +12,7 @@ def known_user(func: Callable) -> Callable:
     def wrapper_func(update: Update, context: CallbackContext) -> None:
         user_id = update.effective_user.id
 
-        found_user = db.users.find_one({'user_id': user_id})
+        found_user = user_directory.get_by_id(user_id)
 
         if not found_user:
             context.bot.send_message(
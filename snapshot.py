@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+import numpy as np
+
+from db import db, iter_tiktoks_sent_between
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+MANIFEST_NAME = 'manifest.json'
+
+TABLES = {
+    'tiktoks': {
+        'message_id': 'int64',
+        'sent_by_id': 'int64',
+        'sent_at': 'datetime64[ms]',
+        'video_id': 'str',
+        'share_key': 'str',
+        'replies_count': 'int32',
+    },
+    'replies': {
+        'tiktok_message_id': 'int64',
+        'tiktok_sent_by_id': 'int64',
+        'tiktok_sent_at': 'datetime64[ms]',
+        'message_id': 'int64',
+        'sent_by_id': 'int64',
+        'sent_at': 'datetime64[ms]',
+        'reply_time_ms': 'int64',
+        'laugh_indicator': 'int32',
+        'text': 'str',
+    },
+    'users': {
+        'user_id': 'int64',
+        'name': 'str',
+        'gen': 'str',
+    },
+}
+
+
+class SnapshotWriter:
+    def __init__(self, path: str, snapshot_format: str, manifest: Optional[dict] = None) -> None:
+        self.path = path
+        self.manifest = manifest or {'format': snapshot_format, 'exported_until': None, 'chunks': []}
+        self.format = self.manifest['format']
+
+    def write_chunk(self, table: str, rows: dict[str, list]) -> None:
+        row_count = len(next(iter(rows.values())))
+
+        if not row_count:
+            return
+
+        name = f'{table}/{len([c for c in self.manifest["chunks"] if c["table"] == table]):05d}'
+        columns = {column: to_array(rows[column], dtype) for column, dtype in TABLES[table].items()}
+
+        if self.format == 'parquet':
+            os.makedirs(os.path.join(self.path, table), exist_ok=True)
+            pyarrow.parquet.write_table(
+                pyarrow.table(columns), os.path.join(self.path, f'{name}.parquet')
+            )
+        else:
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+
+            for column, values in columns.items():
+                if TABLES[table][column] == 'str':
+                    save_strings(os.path.join(self.path, name, column), values)
+                else:
+                    np.save(os.path.join(self.path, name, f'{column}.npy'), values)
+
+        self.manifest['chunks'].append({'table': table, 'name': name, 'rows': row_count})
+
+    def write_users(self, users: list[dict]) -> None:
+        # Users are few and change in place, so each snapshot replaces them
+        self.manifest['chunks'] = [c for c in self.manifest['chunks'] if c['table'] != 'users']
+        self.write_chunk('users', {column: [u.get(column) for u in users] for column in TABLES['users']})
+
+    def save_manifest(self) -> None:
+        path = os.path.join(self.path, MANIFEST_NAME)
+
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+
+        os.replace(f'{path}.tmp', path)
+
+
+def to_array(values: list, dtype: str) -> np.ndarray:
+    if dtype == 'str':
+        # Fixed width unicode arrays pad every value to the longest one
+        array = np.empty(len(values), dtype=object)
+        array[:] = ['' if v is None else v for v in values]
+        return array
+
+    if dtype.startswith('datetime64'):
+        return np.array(values, dtype=dtype)
+
+    return np.array([0 if v is None else v for v in values], dtype=dtype)
+
+
+def save_strings(path: str, values: np.ndarray) -> None:
+    encoded = [v.encode() for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    np.cumsum([len(v) for v in encoded], out=offsets[1:])
+
+    np.save(f'{path}.offsets.npy', offsets)
+    np.save(f'{path}.npy', np.frombuffer(b''.join(encoded), dtype='uint8'))
+
+
+def load_strings(path: str) -> np.ndarray:
+    offsets = np.load(f'{path}.offsets.npy', mmap_mode='r')
+    data = np.load(f'{path}.npy', mmap_mode='r')
+
+    return to_array([
+        bytes(data[start:end]).decode() for start, end in zip(offsets[:-1], offsets[1:])
+    ], 'str')
+
+
+def export_snapshot(path: str, snapshot_format: str, settle_days: int, chunk_rows: int, batch_size: int) -> dict:
+    manifest = read_manifest(path)
+
+    if manifest and snapshot_format not in ('auto', manifest['format']):
+        raise ValueError(f"Snapshot at {path} is {manifest['format']}, cannot append {snapshot_format}")
+
+    if snapshot_format == 'auto':
+        snapshot_format = 'parquet' if pyarrow else 'npy'
+
+    if snapshot_format == 'parquet' and not pyarrow:
+        raise ValueError('pyarrow is not installed, use --format npy')
+
+    os.makedirs(path, exist_ok=True)
+    writer = SnapshotWriter(path, snapshot_format, manifest)
+
+    # Replies keep coming for a few days, so only tiktoks older than that are appended
+    exported_from = datetime.fromisoformat(manifest['exported_until']) if manifest else None
+    exported_until = (datetime.utcnow() - timedelta(days=settle_days)).replace(microsecond=0)
+
+    tiktok_rows = {column: [] for column in TABLES['tiktoks']}
+    reply_rows = {column: [] for column in TABLES['replies']}
+
+    for tiktok in iter_tiktoks_sent_between(exported_from, exported_until, batch_size):
+        append_tiktok_rows(tiktok, tiktok_rows, reply_rows)
+
+        if len(tiktok_rows['message_id']) >= chunk_rows:
+            writer.write_chunk('tiktoks', tiktok_rows)
+            tiktok_rows = {column: [] for column in TABLES['tiktoks']}
+
+        if len(reply_rows['message_id']) >= chunk_rows:
+            writer.write_chunk('replies', reply_rows)
+            reply_rows = {column: [] for column in TABLES['replies']}
+
+    writer.write_chunk('tiktoks', tiktok_rows)
+    writer.write_chunk('replies', reply_rows)
+    writer.write_users(list(db.users.find({}, {'_id': 0, 'user_id': 1, 'name': 1, 'gen': 1})))
+
+    writer.manifest['exported_until'] = exported_until.isoformat()
+    writer.save_manifest()
+
+    return writer.manifest
+
+
+def append_tiktok_rows(tiktok: dict, tiktok_rows: dict[str, list], reply_rows: dict[str, list]) -> None:
+    replies = [r for r in tiktok.get('replies') or [] if r['sent_by_id'] != tiktok['sent_by_id']]
+
+    for column in ('message_id', 'sent_by_id', 'sent_at', 'video_id', 'share_key'):
+        tiktok_rows[column].append(tiktok.get(column))
+
+    tiktok_rows['replies_count'].append(len(replies))
+
+    for reply in replies:
+        reply_rows['tiktok_message_id'].append(tiktok['message_id'])
+        reply_rows['tiktok_sent_by_id'].append(tiktok['sent_by_id'])
+        reply_rows['tiktok_sent_at'].append(tiktok['sent_at'])
+        reply_rows['reply_time_ms'].append((reply['sent_at'] - tiktok['sent_at']) // timedelta(milliseconds=1))
+
+        for column in ('message_id', 'sent_by_id', 'sent_at', 'laugh_indicator', 'text'):
+            reply_rows[column].append(reply.get(column))
+
+
+def read_manifest(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def iter_chunks(path: str, table: str) -> Iterator[dict[str, np.ndarray]]:
+    manifest = read_manifest(path)
+
+    if not manifest:
+        raise FileNotFoundError(f'No snapshot at {path}')
+
+    for chunk in manifest['chunks']:
+        if chunk['table'] != table:
+            continue
+
+        if manifest['format'] == 'parquet':
+            chunk_table = pyarrow.parquet.read_table(os.path.join(path, f"{chunk['name']}.parquet"), memory_map=True)
+            yield {column: chunk_table.column(column).to_numpy() for column in chunk_table.column_names}
+        else:
+            yield {
+                column: load_strings(os.path.join(path, chunk['name'], column)) if dtype == 'str'
+                else np.load(os.path.join(path, chunk['name'], f'{column}.npy'), mmap_mode='r')
+                for column, dtype in TABLES[table].items()
+            }
+
+
+def load_table(path: str, table: str) -> dict[str, np.ndarray]:
+    chunks = list(iter_chunks(path, table))
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    if not chunks:
+        return {column: to_array([], dtype) for column, dtype in TABLES[table].items()}
+
+    return {column: np.concatenate([c[column] for c in chunks]) for column in TABLES[table]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export tiktoks, replies and users into a local columnar snapshot')
+    parser.add_argument('path', help='snapshot directory, appended to when it already has a manifest')
+    parser.add_argument('--format', choices=['auto', 'npy', 'parquet'], default='auto',
+                        help='parquet needs pyarrow, npy numeric columns can be loaded with mmap_mode="r"')
+    parser.add_argument('--settle-days', type=int, default=7, help='skip tiktoks that may still get replies')
+    parser.add_argument('--chunk-rows', type=int, default=100_000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    try:
+        manifest = export_snapshot(args.path, args.format, args.settle_days, args.chunk_rows, args.batch_size)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    rows = {}
+
+    for chunk in manifest['chunks']:
+        rows[chunk['table']] = rows.get(chunk['table'], 0) + chunk['rows']
+
+    print(f"Snapshot is {manifest['format']} until {manifest['exported_until']}: {rows}")
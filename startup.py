@@ -0,0 +1,27 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class StartupTimer:
+    def __init__(self) -> None:
+        self.phases = []
+        self._started_at = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started_at))
+
+    def report(self) -> str:
+        total = time.perf_counter() - self._started_at
+        width = max([len(name) for name, _ in self.phases] + [len('total')])
+
+        lines = [f'{name:<{width}}  {elapsed * 1000:>8.1f} ms' for name, elapsed in self.phases]
+        lines.append(f"{'total':<{width}}  {total * 1000:>8.1f} ms")
+
+        return '\n'.join(lines)
@@ -0,0 +1,75 @@
+import threading
+
+from cache import MISSING, LRUCache, QueryCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is MISSING
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_expires_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('cache.time.monotonic', lambda: now[0])
+
+    cache = LRUCache(maxsize=10, ttl=5)
+    cache.set('default', 1)
+    cache.set('longer', 2, ttl=60)
+
+    now[0] += 10
+
+    assert cache.get('default') is MISSING
+    assert cache.get('longer') == 2
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_query_cache_returns_cached_result_until_invalidated():
+    query_cache = QueryCache(maxsize=10)
+    calls = []
+
+    @query_cache.cached
+    def query(user_id, limit=10):
+        calls.append((user_id, limit))
+        return len(calls)
+
+    assert query(1) == 1
+    assert query(1) == 1
+    assert query(1, limit=5) == 2
+
+    query_cache.invalidate()
+
+    assert query(1) == 3
+    assert calls == [(1, 10), (1, 5), (1, 10)]
+
+
+def test_query_cache_drops_result_computed_across_invalidation():
+    query_cache = QueryCache(maxsize=10)
+    started, invalidated = threading.Event(), threading.Event()
+    results = iter(['stale', 'fresh'])
+
+    @query_cache.cached
+    def query():
+        result = next(results)
+
+        if result == 'stale':
+            started.set()
+            invalidated.wait(timeout=5)
+
+        return result
+
+    reader = threading.Thread(target=query)
+    reader.start()
+    started.wait(timeout=5)
+    query_cache.invalidate()
+    invalidated.set()
+    reader.join(timeout=5)
+
+    assert query() == 'fresh'
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip('pymongo')
+
+from db import LATENCY_BUCKETS_MS, MINUTE_MS, _get_histogram_median  # noqa: E402
+
+
+def test_histogram_median_of_empty_histogram():
+    assert _get_histogram_median([]) is None
+    assert _get_histogram_median([0] * (len(LATENCY_BUCKETS_MS) + 1)) is None
+
+
+def test_histogram_median_interpolates_inside_bucket():
+    assert _get_histogram_median([4]) == 0.5 * MINUTE_MS
+    assert _get_histogram_median([0, 2, 2]) == 5 * MINUTE_MS
+    assert _get_histogram_median([1, 3]) == MINUTE_MS + (5 - 1) * MINUTE_MS / 3
+
+
+def test_histogram_median_in_open_bucket_is_its_lower_bound():
+    counts = [0] * len(LATENCY_BUCKETS_MS) + [3]
+
+    assert _get_histogram_median(counts) == LATENCY_BUCKETS_MS[-1]
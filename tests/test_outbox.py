@@ -0,0 +1,100 @@
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram.error import NetworkError, RetryAfter  # noqa: E402
+
+from outbox import MAX_ATTEMPTS, MAX_MESSAGE_LENGTH, Outbox  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, errors=()) -> None:
+        self.errors = list(errors)
+        self.calls = []
+
+    def send_message(self, **kwargs) -> None:
+        self.calls.append(kwargs)
+
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def test_plain_messages_to_one_chat_are_coalesced():
+    outbox = Outbox(FakeBot())
+    outbox.send_message(1, 'first')
+    outbox.send_message(1, 'second')
+    outbox.send_message(1, 'formatted', parse_mode='HTML')
+    outbox.send_message(1, 'third')
+
+    assert outbox._take_coalesced(1)['kwargs'] == {'chat_id': 1, 'text': 'first\n\nsecond'}
+    assert outbox._take_coalesced(1)['kwargs'] == {'chat_id': 1, 'text': 'formatted', 'parse_mode': 'HTML'}
+    assert outbox._take_coalesced(1)['kwargs'] == {'chat_id': 1, 'text': 'third'}
+
+
+def test_coalesced_message_fits_telegram_limit():
+    outbox = Outbox(FakeBot())
+    outbox.send_message(1, 'a' * (MAX_MESSAGE_LENGTH - 10))
+    outbox.send_message(1, 'b' * 10)
+
+    assert outbox._take_coalesced(1)['kwargs']['text'] == 'a' * (MAX_MESSAGE_LENGTH - 10)
+    assert outbox._take_coalesced(1)['kwargs']['text'] == 'b' * 10
+
+
+def test_chat_waits_for_its_interval(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('outbox.time.monotonic', lambda: now[0])
+
+    outbox = Outbox(FakeBot(), chat_interval=1, global_per_second=30)
+    outbox._chat_ready_at[1] = 100.5
+    outbox.send_message(1, 'busy chat')
+
+    assert outbox._get_ready_chat() == (None, 0.5)
+
+    outbox.send_message(2, 'idle chat')
+
+    assert outbox._get_ready_chat() == (2, None)
+
+
+def test_global_rate_limit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('outbox.time.monotonic', lambda: now[0])
+
+    outbox = Outbox(FakeBot(), chat_interval=0, global_per_second=2)
+    outbox._sent_at.extend([99.25, 99.75])
+    outbox.send_message(1, 'text')
+
+    assert outbox._get_ready_chat() == (None, 0.25)
+
+    now[0] = 100.5
+
+    assert outbox._get_ready_chat() == (1, None)
+
+
+def test_retry_after_puts_message_back_first():
+    outbox = Outbox(FakeBot(errors=[RetryAfter(3)]))
+    outbox.send_message(1, 'queued')
+    message = outbox._take_coalesced(1)
+    outbox.send_message(1, 'later')
+
+    outbox._deliver(1, message)
+
+    assert [m['kwargs']['text'] for m in outbox._chat_queues[1]] == ['queued', 'later']
+
+
+def test_network_errors_are_retried_up_to_max_attempts():
+    outbox = Outbox(FakeBot(errors=[NetworkError('timeout')] * MAX_ATTEMPTS), chat_interval=0)
+    outbox.send_message(1, 'text')
+
+    while outbox._chat_queues[1]:
+        outbox._deliver(1, outbox._take_coalesced(1))
+
+    assert len(outbox.bot.calls) == MAX_ATTEMPTS
+
+
+def test_unexpected_error_does_not_stop_delivery():
+    outbox = Outbox(FakeBot(errors=[ValueError('unexpected')]))
+    outbox.send_message(1, 'text')
+
+    outbox._deliver(1, outbox._take_coalesced(1))
+
+    assert not outbox._chat_queues[1]
@@ -0,0 +1,15 @@
+import pytest
+
+from plural import _get_plural_form_index, make_agree_with_number
+
+
+@pytest.mark.parametrize('number, index', [
+    (0, 2), (1, 0), (2, 1), (4, 1), (5, 2), (11, 2), (12, 2), (14, 2), (21, 0),
+    (22, 1), (25, 2), (101, 0), (111, 2), (112, 2), (1004, 1), (-1, 0), (-3, 1),
+])
+def test_get_plural_form_index(number, index):
+    assert _get_plural_form_index(number) == index
+
+
+def test_make_agree_with_number_uses_table_forms():
+    assert [make_agree_with_number('тикток', n) for n in (1, 3, 11)] == ['тикток', 'тиктока', 'тиктоков']
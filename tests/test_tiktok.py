@@ -0,0 +1,18 @@
+import pytest
+
+from tiktok import get_share_key
+
+
+@pytest.mark.parametrize('text, share_key', [
+    ('https://vm.tiktok.com/ZSeQm1Abc/', 'ZSeQm1Abc'),
+    ('https://vm.tiktok.com/ZSeQm1Abc', 'ZSeQm1Abc'),
+    ('  https://vm.tiktok.com/ZSeQm1Abc/ ахах', 'ZSeQm1Abc'),
+    ('смотри https://vm.tiktok.com/ZSeQm1Abc/', 'ZSeQm1Abc'),
+    ('первый https://vm.tiktok.com/ZSfirst/ и второй https://vm.tiktok.com/ZSsecond/', 'ZSfirst'),
+    ('https://www.tiktok.com/@user/video/6900000000000000000', None),
+    ('просто текст', None),
+    ('', None),
+    (None, None),
+])
+def test_get_share_key(text, share_key):
+    assert get_share_key(text) == share_key
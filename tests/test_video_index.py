@@ -0,0 +1,35 @@
+from video_index import VideoIdIndex
+
+
+def test_everything_might_be_contained_until_loaded():
+    index = VideoIdIndex()
+
+    assert index.might_contain('6900000000000000001')
+
+    index.load([])
+
+    assert not index.might_contain('6900000000000000001')
+
+
+def test_removed_id_is_kept_while_other_tiktoks_have_it():
+    index = VideoIdIndex()
+    index.load(['a', 'a', 'b'])
+    index.remove('a')
+    index.remove('b')
+
+    assert index.might_contain('a')
+    assert not index.might_contain('b')
+
+
+def test_id_added_during_reload_is_kept():
+    index = VideoIdIndex()
+    index.load(['a'])
+
+    def scan():
+        yield 'a'
+        index.add('b')
+        yield 'c'
+
+    index.load(scan())
+
+    assert all(index.might_contain(video_id) for video_id in ('a', 'b', 'c'))
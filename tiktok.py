@@ -1,17 +1,45 @@
+import os
 import re
 from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 
 EXTRACT_SHARE_URL_FROM_TIKTOK = r'[\s.]*(https:\/\/vm.tiktok.com/[^\s^\/]+).*'
 
 EXTRACT_TIKTOK_ID_FROM_URL = r'https:\/\/m.tiktok.com\/v\/(.*)\.html'
 
+EXTRACT_SHARE_CODE_FROM_URL = r'https:\/\/vm.tiktok.com\/([^\s\/?#]+)'
+
+REQUEST_TIMEOUT = float(os.environ.get('TIKTOK_REQUEST_TIMEOUT', 5))
+
+session = requests.Session()
+
+
+def set_session_pool_size(size: int) -> None:
+    # Threads beyond the pool size open and drop a new connection per request
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=size))
+
+
+set_session_pool_size(int(os.environ.get('RESOLVER_WORKERS', 4)))
+
 
 def get_tiktok_id_by_share_url(share_url: str) -> Optional[str]:
-    video_url = requests.get(share_url, allow_redirects=False).headers['Location']
+    video_url = session.get(
+        share_url, allow_redirects=False, timeout=REQUEST_TIMEOUT
+    ).headers['Location']
 
     if m := re.match(EXTRACT_TIKTOK_ID_FROM_URL, video_url):
         return m.group(1)
 
     return None
+
+
+def get_share_key(text: str) -> Optional[str]:
+    if not (m := re.search(EXTRACT_SHARE_URL_FROM_TIKTOK, text or '')):
+        return None
+
+    if code := re.match(EXTRACT_SHARE_CODE_FROM_URL, m.group(1)):
+        return code.group(1)
+
+    return None
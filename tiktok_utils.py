@@ -1,14 +1,25 @@
 from datetime import timedelta
+from typing import Optional
 
 DAY = 60 * 60 * 24
 
 
-def count_laugh_indicator(text: str) -> int:
+def count_laugh_indicator(text: Optional[str]) -> int:
+    if not text:
+        return 0
+
     small_ah_count = text.count('ах')
     caps_ah_count = text.count('АХ')
     return small_ah_count + caps_ah_count * 2
 
 
+def normalize_reaction(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return None
+
+    return ' '.join(text.lower().split()) or None
+
+
 def milliseconds_to_string_duration(milliseconds: float) -> str:
     duration = timedelta(milliseconds=milliseconds)
     days = duration.days
@@ -0,0 +1,50 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from db import db
+
+MISS_REFRESH_INTERVAL_SECONDS = 30
+
+
+class UserDirectory:
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._by_id = {}
+        self._by_name = {}
+        self._sorted_by_name = []
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> None:
+        users = list(db.users.find({}).sort('name', 1))
+
+        with self._lock:
+            self._by_id = {u['user_id']: u for u in users}
+            self._by_name = {u['name'].lower(): u for u in users}
+            self._sorted_by_name = users
+            self._loaded_at = time.monotonic()
+
+    def get_by_id(self, user_id: int) -> Optional[dict]:
+        self._refresh_if_expired()
+
+        if user_id not in self._by_id and time.monotonic() - self._loaded_at > MISS_REFRESH_INTERVAL_SECONDS:
+            self.refresh()
+
+        return self._by_id.get(user_id)
+
+    def get_by_name(self, name: str) -> Optional[dict]:
+        self._refresh_if_expired()
+        return self._by_name.get(name.lower())
+
+    def get_all(self) -> list[dict]:
+        self._refresh_if_expired()
+        return self._sorted_by_name
+
+    def _refresh_if_expired(self) -> None:
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self.refresh()
+
+
+user_directory = UserDirectory(ttl=int(os.environ.get('USER_DIRECTORY_TTL_SECONDS', 600)))
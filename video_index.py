@@ -0,0 +1,44 @@
+import threading
+from collections import Counter
+from typing import Iterable
+
+
+class VideoIdIndex:
+    def __init__(self) -> None:
+        self.loaded = False
+        self._counts = Counter()
+        self._added_while_loading = None
+        self._lock = threading.Lock()
+
+    def load(self, video_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._added_while_loading = Counter()
+
+        counts = Counter(video_ids)
+
+        with self._lock:
+            # An id added after the scan passed it would be lost, an extra count only costs a query
+            counts.update(self._added_while_loading)
+            self._counts = counts
+            self._added_while_loading = None
+            self.loaded = True
+
+    def add(self, video_id: str) -> None:
+        with self._lock:
+            self._counts[video_id] += 1
+
+            if self._added_while_loading is not None:
+                self._added_while_loading[video_id] += 1
+
+    def remove(self, video_id: str) -> None:
+        with self._lock:
+            if self._counts[video_id] > 1:
+                self._counts[video_id] -= 1
+            else:
+                self._counts.pop(video_id, None)
+
+    def might_contain(self, video_id: str) -> bool:
+        return not self.loaded or video_id in self._counts
+
+    def __len__(self) -> int:
+        return len(self._counts)
@@ -0,0 +1,63 @@
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.ext import Dispatcher
+from telegram.update import Update
+
+ENQUEUE_TIMEOUT_SECONDS = 5
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, listen: str, port: int, url_path: str, dispatcher: Dispatcher) -> None:
+        super().__init__((listen, port), WebhookRequestHandler)
+        self.url_path = url_path
+        self.dispatcher = dispatcher
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: WebhookServer
+
+    def do_POST(self) -> None:
+        if self.path != self.server.url_path:
+            self._respond(404)
+            return
+
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            update = Update.de_json(payload, self.server.dispatcher.bot)
+        except (ValueError, TypeError, KeyError):
+            self._respond(400)
+            return
+
+        try:
+            self.server.dispatcher.update_queue.put(update, timeout=ENQUEUE_TIMEOUT_SECONDS)
+        except queue.Full:
+            # Telegram redelivers the update later, which is the backpressure we want
+            self._respond(503)
+            return
+
+        self._respond(200)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _respond(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def serve_webhook(dispatcher: Dispatcher, listen: str, port: int, url_path: str) -> None:
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+
+    with WebhookServer(listen, port, url_path, dispatcher) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dispatcher.stop()